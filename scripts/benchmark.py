@@ -0,0 +1,248 @@
+# benchmarks the stages of verify.py, report.py and compile.py on synthetic flights
+#
+# runs fully offline: navdata is generated by synthetic.py and injected via a
+# navdata getter for the synthetic platform. Results are written as JSON.
+# The import time of the command line modules is recorded as well, as it
+# dominates short runs (e.g. verify --schema-only in a pre-commit hook).
+# With --check, it is only checked that these short runs don't import heavy
+# dependencies.
+
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import tempfile
+from io import StringIO
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(results, stage, config, n_items=None):
+    t0 = time.perf_counter()
+    yield
+    results.append({**config,
+                    "stage": stage,
+                    "seconds": time.perf_counter() - t0,
+                    "n_items": n_items})
+
+
+IMPORT_TIME_MODULES = ["flightseg", "checkers", "verify", "compile", "report"]
+
+HEAVY_MODULES = ["xarray", "matplotlib"]
+
+# short runs and the modules they must not import, {workdir} contains a synthetic flight
+LIGHT_COMMANDS = [
+    (["flightseg.py", "--help"], HEAVY_MODULES + ["numpy"]),
+    (["flightseg.py", "verify", "--help"], HEAVY_MODULES + ["numpy"]),
+    (["flightseg.py", "report", "--help"], HEAVY_MODULES + ["numpy"]),
+    (["flightseg.py", "compile", "--help"], HEAVY_MODULES + ["numpy"]),
+    (["verify.py", "--schema-only", "--no-cache", "-s", "{workdir}/sondes.yaml", "{workdir}/SYNTHETIC-20240801a.yaml"],
+     HEAVY_MODULES),
+]
+
+
+def _run_importtime(args):
+    """
+    runs python -X importtime with args in the scripts directory
+
+    :returns: list of (module, cumulative seconds) in the order reported
+    """
+    import subprocess
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("{} failed:\n{}".format(" ".join(args), "\n".join(
+            line for line in result.stderr.splitlines() if not line.startswith("import time:"))))
+    modules = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((parts[2].strip(), int(parts[1]) / 1e6))
+    return modules
+
+
+def import_time(module):
+    """
+    :returns: seconds spent importing module in a fresh interpreter, as reported by python -X importtime
+    """
+    for name, seconds in _run_importtime(["-c", "import " + module]):
+        if name == module:
+            return seconds
+    raise ValueError("no import time reported for {}".format(module))
+
+
+def check_imports(workdir):
+    """
+    runs LIGHT_COMMANDS in fresh interpreters
+
+    :param workdir: directory for the synthetic flight
+    :returns: list of problems, empty if no command imports any of the modules it must not import
+    """
+    _run_importtime(["synthetic.py", "SYNTHETIC-20240801a", "-o", workdir])
+    problems = []
+    for command, forbidden in LIGHT_COMMANDS:
+        command = [arg.format(workdir=workdir) for arg in command]
+        try:
+            imported = {name.lstrip().split(".")[0] for name, _ in _run_importtime(command)}
+        except RuntimeError as e:
+            problems.append(str(e))
+            continue
+        heavy = [module for module in forbidden if module in imported]
+        if heavy:
+            problems.append("{} imports {}".format(" ".join(command), ", ".join(heavy)))
+    return problems
+
+
+def run_config(n_flights, rate_hz, n_circles, n_filler_sondes, n_plot_flights, workdir):
+    import yaml
+    import numpy as np
+    import matplotlib
+    matplotlib.use("Agg")
+
+    import navdata
+    import report
+    import compile
+    from synthetic import synthetic_flight, filler_sondes, SYNTHETIC_PLATFORM
+    from checkers import check_flight_batch
+    from sondeindex import load_sonde_index
+    from yamlload import load_yaml
+
+    config = {"n_flights": n_flights, "rate_hz": rate_hz, "n_circles": n_circles,
+              "n_filler_sondes": n_filler_sondes}
+    results = []
+
+    flights_navdata = {}
+    segment_files = []
+    all_sondes = filler_sondes(n_filler_sondes)
+    for i in range(n_flights):
+        takeoff = datetime.datetime(2024, 8, 1) + datetime.timedelta(days=i)
+        flight_id = "{}-{:%Y%m%d}a".format(SYNTHETIC_PLATFORM, takeoff)
+        nav, flight, sondes = synthetic_flight(flight_id, takeoff, n_circles=n_circles,
+                                               rate_hz=rate_hz, seed=i)
+        flights_navdata[flight_id] = nav
+        all_sondes += sondes
+        filename = os.path.join(workdir, flight_id + ".yaml")
+        with open(filename, "w") as f:
+            yaml.dump(flight, f, sort_keys=False)
+        segment_files.append(filename)
+
+    sonde_file = os.path.join(workdir, "sondes.yaml")
+    with open(sonde_file, "w") as f:
+        yaml.dump(all_sondes, f)
+
+    navdata.NAVDATA_GETTERS[SYNTHETIC_PLATFORM] = flights_navdata.__getitem__
+
+    with timed(results, "yaml_load", config, len(segment_files) + 1):
+        flights = [load_yaml(filename, cache=False) for filename in segment_files]
+        sonde_index = load_sonde_index(sonde_file, cache=False)
+
+    segments = [(flight, seg) for flight in flights for seg in flight["segments"]]
+
+    with timed(results, "sonde_assignment", config, len(segments)):
+        sondes_by_flag = [sonde_index.sondes_by_flag(flight["platform"], seg["start"], seg["end"])
+                          for flight, seg in segments]
+
+    with timed(results, "navdata_get", config, len(flights)):
+        navs = [navdata.get_navdata(flight["platform"], flight["flight_id"]).load()
+                for flight in flights]
+
+    with timed(results, "navdata_sel", config, len(segments)):
+        seg_navdata = [nav.sel(time=slice(np.datetime64(seg["start"]), np.datetime64(seg["end"])))
+                       for flight, nav in zip(flights, navs)
+                       for seg in flight["segments"]]
+
+    with timed(results, "checks", config, len(segments)):
+        n_warnings = sum(len(check_flight_batch(flight, nav, sonde_index))
+                         for flight, nav in zip(flights, navs))
+    results[-1]["n_warnings"] = n_warnings
+
+    plot_flights = flights[:n_plot_flights]
+    plot_tasks = []
+    i = 0
+    for k, (flight, nav) in enumerate(zip(flights, navs)):
+        for seg in flight["segments"]:
+            if k < n_plot_flights:
+                t_start = np.datetime64(seg["start"])
+                t_end = np.datetime64(seg["end"])
+                before = nav.sel(time=slice(t_start - report.border_time, t_start))
+                after = nav.sel(time=slice(t_end, t_end + report.border_time))
+                for j in range(len(report.plots_for_kinds(seg["kinds"]))):
+                    plot_tasks.append((seg, (seg["kinds"], j, seg_navdata[i], {}, before, after)))
+            i += 1
+
+    with timed(results, "plotting", config, len(plot_tasks)):
+        for seg, plot_args in plot_tasks:
+            url, warning = report.render_plot(*plot_args)
+            seg.setdefault("plot_data", []).append(url)
+
+    with timed(results, "template_render", config, len(plot_flights)):
+        tpl = report.template_env().get_template("flight.html")
+        for flight in plot_flights:
+            for seg in flight["segments"]:
+                seg.setdefault("warnings", [])
+                seg.setdefault("sondes_by_flag", {})
+            tpl.render(flight={**flight, "warnings": [], "plot_data": ""})
+
+    with timed(results, "compile", config, len(flights)):
+        compiled = compile.compile_flights(load_yaml(filename, cache=False) for filename in segment_files)
+        yaml.dump(compiled, StringIO(), allow_unicode=True, sort_keys=False)
+
+    with timed(results, "compile_columnar", config, len(flights)):
+        compile.to_columnar(compiled)
+
+    return results
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark verify/report/compile stages on synthetic flights")
+    parser.add_argument("-n", "--n-flights", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("-r", "--rate", type=float, nargs="+", default=[10.], help="navdata sample rates in Hz")
+    parser.add_argument("-c", "--circles", type=int, default=4, help="circles per flight")
+    parser.add_argument("--filler-sondes", type=int, default=5000, help="sondes of other platforms in sondes.yaml")
+    parser.add_argument("--plot-flights", type=int, default=1, help="number of flights to render plots for")
+    parser.add_argument("-o", "--outfile", help="JSON output file, defaults to stdout")
+    parser.add_argument("--check", action="store_true",
+                        help="only check that --help (also not numpy) and verify --schema-only don't import {}".format(
+                            " or ".join(HEAVY_MODULES)))
+    args = parser.parse_args()
+
+    if args.check:
+        with tempfile.TemporaryDirectory() as workdir:
+            problems = check_imports(workdir)
+        for problem in problems:
+            print("ERROR: " + problem, file=sys.stderr)
+        print("import check {}".format("failed" if problems else "passed"), file=sys.stderr)
+        return 1 if problems else 0
+
+    results = [{"stage": "import_" + module, "seconds": min(import_time(module) for _ in range(3)),
+                "n_items": 1}
+               for module in IMPORT_TIME_MODULES]
+    for n_flights in args.n_flights:
+        for rate_hz in args.rate:
+            with tempfile.TemporaryDirectory() as workdir:
+                results += run_config(n_flights, rate_hz, args.circles, args.filler_sondes,
+                                      args.plot_flights, workdir)
+
+    output = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if args.outfile:
+        with open(args.outfile, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(_main())
@@ -1,4 +1,15 @@
-import numpy as np
+
+# irregularity tags which are interpreted by the checks, see README
+IRREGULARITY_TAGS = ["TTFS", "SAM", "CIRC", "ROLL", "ALT", "GAP"]
+
+EARTH_RADIUS = 6371e3
+
+# limits of the navdata checks
+CIRCLE_RADIUS_RANGE = (20e3, 150e3)  # m
+MAX_CIRCLE_FIT_RESIDUAL = .05  # rms distance from the fitted circle, relative to its radius
+MAX_STRAIGHT_LEG_ROLL = 5.  # deg
+MAX_ALTITUDE_RANGE = 200.  # m, on circles and straight legs
+MAX_NAVDATA_GAP = 10  # s
 
 
 def kinds_is_circle(kinds):
@@ -9,92 +20,323 @@ def has_irregularity(irregularities, irregularity_tag):
     return any(i.startswith(irregularity_tag) for i in irregularities)
 
 
+def fit_circle(lat, lon):
+    """
+    least squares fit of a circle to a track
+
+    The track is projected onto a plane tangent at its mean position, which
+    is accurate enough for circles of a few hundred kilometers.
+
+    :returns: (center_lat, center_lon, radius, rms residual), radius and residual in m
+    """
+    import numpy as np
+    lat0 = np.mean(lat)
+    lon0 = np.mean(lon)
+    y = np.deg2rad(lat - lat0) * EARTH_RADIUS
+    x = np.deg2rad(lon - lon0) * EARTH_RADIUS * np.cos(np.deg2rad(lat0))
+
+    # (x - a)^2 + (y - b)^2 = r^2 is linear in a, b and c = r^2 - a^2 - b^2
+    A = np.stack([2 * x, 2 * y, np.ones_like(x)], axis=-1)
+    (a, b, c), *_ = np.linalg.lstsq(A, x**2 + y**2, rcond=None)
+    radius = np.sqrt(c + a**2 + b**2)
+    residual = np.sqrt(np.mean((np.hypot(x - a, y - b) - radius)**2))
+
+    center_lat = lat0 + np.rad2deg(b / EARTH_RADIUS)
+    center_lon = lon0 + np.rad2deg(a / EARTH_RADIUS / np.cos(np.deg2rad(lat0)))
+    return center_lat, center_lon, radius, residual
+
+
+def check_navdata(kinds, irregularities, navdata, t_start, t_end):
+    """
+    geometric checks of the navdata within a segment
+
+    :param navdata: navdata between t_start and t_end
+    """
+    import numpy as np
+    time = navdata.time.values
+    lat = navdata["lat"].values
+    lon = navdata["lon"].values
+    alt = navdata["alt"].values
+    valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(alt)
+
+    if not np.any(valid):
+        yield "no navdata within segment"
+        return
+
+    if not has_irregularity(irregularities, "GAP"):
+        edges = np.concatenate([[t_start], time[valid], [t_end]])
+        gaps = np.diff(edges)
+        max_gap = np.timedelta64(MAX_NAVDATA_GAP, "s")
+        n_gaps = np.count_nonzero(gaps > max_gap)
+        if n_gaps > 0:
+            yield "navdata has {} gaps longer than {}, the longest is {:.0f} s and no GAP irregularity is recorded".format(
+                n_gaps, max_gap, np.max(gaps) / np.timedelta64(1, "s"))
+
+    lat, lon, alt = lat[valid], lon[valid], alt[valid]
+
+    if (kinds_is_circle(kinds) or "straight_leg" in kinds) and not has_irregularity(irregularities, "ALT"):
+        alt_range = np.max(alt) - np.min(alt)
+        if alt_range > MAX_ALTITUDE_RANGE:
+            yield "altitude varies by {:.0f} m and no ALT irregularity is recorded".format(alt_range)
+
+    if "straight_leg" in kinds and not has_irregularity(irregularities, "ROLL"):
+        roll = navdata["roll"].values[valid]
+        max_roll = np.nanmax(np.abs(roll)) if np.any(np.isfinite(roll)) else 0.
+        if max_roll > MAX_STRAIGHT_LEG_ROLL:
+            yield "roll angle on straight leg reaches {:.1f} deg and no ROLL irregularity is recorded".format(max_roll)
+
+    if kinds_is_circle(kinds) and len(lat) >= 3 and not has_irregularity(irregularities, "CIRC"):
+        _, _, radius, residual = fit_circle(lat, lon)
+        if not CIRCLE_RADIUS_RANGE[0] <= radius <= CIRCLE_RADIUS_RANGE[1]:
+            yield "fitted circle radius is {:.1f} km and no CIRC irregularity is recorded".format(radius / 1e3)
+        elif residual > MAX_CIRCLE_FIT_RESIDUAL * radius:
+            yield "track deviates from fitted circle by {:.1f} km rms and no CIRC irregularity is recorded".format(
+                residual / 1e3)
+
+
+def _segment_fields(seg, flight_id):
+    """
+    checks the fields of a single segment without modifying it
+
+    :returns: (list of (check, message), kinds, irregularities)
+    """
+    warnings = []
+    if "segment_id" not in seg:
+        warnings.append(("segment_id", "segment_id is missing"))
+    elif not str(seg["segment_id"]).startswith(flight_id):
+        warnings.append(("segment_id", "segment_id does not start with flight_id"))
+
+    kinds = seg.get("kinds")
+    if "kinds" not in seg:
+        warnings.append(("kinds", "segment has no kinds attribute"))
+        kinds = []
+    elif not isinstance(kinds, list):
+        warnings.append(("kinds", "kinds is not a list"))
+        kinds = []
+    elif len(kinds) == 0:
+        warnings.append(("kinds", "segment has no kinds"))
+
+    irregularities = seg.get("irregularities")
+    if "irregularities" not in seg:
+        warnings.append(("irregularities", "segment has no irregularities attribute"))
+        irregularities = []
+    elif not isinstance(irregularities, list):
+        warnings.append(("irregularities", "irregularities is not a list"))
+        irregularities = []
+    elif not all(isinstance(i, str) for i in irregularities):
+        warnings.append(("irregularities", "irregularities is not a list of str"))
+        irregularities = []
+
+    if "good_dropsondes" in seg:
+        warnings.append(("dropsondes", "good_dropsondes attribute is deprecated. uses dropsondes instead"))
+    if "dropsondes" not in seg:
+        warnings.append(("dropsondes", "dropsondes attribute is missing"))
+    elif not isinstance(seg["dropsondes"], dict):
+        warnings.append(("dropsondes", "dropsondes is not a mapping"))
+    else:
+        for flag, sonde_ids in seg["dropsondes"].items():
+            if not isinstance(sonde_ids, list):
+                warnings.append(("dropsondes", "dropsondes with flag {} are not a list".format(flag)))
+
+    return warnings, kinds, irregularities
+
+
+# order of the warnings of a segment, as reported by FlightChecker.check_segment
+CHECK_ORDER = ["flight", "segment_id", "kinds", "time", "irregularities", "dropsondes", "overlap", "sondes", "navdata"]
+
+
+def _running_argmax(values):
+    """
+    :returns: index of the maximum of values[:i + 1] for every i
+    """
+    import numpy as np
+    running_max = np.maximum.accumulate(values)
+    return np.maximum.accumulate(np.where(values == running_max, np.arange(len(values)), 0))
+
+
+def check_flight_batch(flight, navdata, sonde_index):
+    """
+    runs all checks on a flight at once
+
+    Segments are converted to arrays once, cross-segment checks (duplicate
+    ids, overlaps of segments of the same kind, segments outside of the
+    flight) and sonde checks are vectorized interval operations. Nothing in
+    the flight is modified.
+
+    :param navdata: navdata of the flight, at least covering all segments,
+                    None to only run the checks of the segment file and sondes
+    :param sonde_index: SondeIndex of all sondes
+    :returns: warnings table as list of dicts with segment (index into
+              flight["segments"] or None for flight warnings), segment_id,
+              check and message, sorted by segment
+    """
+    import numpy as np
+    table = []
+
+    def add(segment, check, message):
+        table.append({"segment": segment,
+                      "segment_id": None if segment is None else segment_ids[segment] or None,
+                      "check": check,
+                      "message": message})
+
+    segments = flight.get("segments", [])
+    flight_id = flight.get("flight_id", "")
+    segment_ids = np.array([str(seg.get("segment_id", "")) for seg in segments], dtype=object)
+
+    if "flight_id" not in flight:
+        add(None, "flight", "flight_id is missing")
+    if "platform" not in flight:
+        add(None, "flight", "platform is missing")
+
+    n = len(segments)
+    starts = np.array([np.datetime64(seg["start"], "ns") for seg in segments], dtype="datetime64[ns]")
+    ends = np.array([np.datetime64(seg["end"], "ns") for seg in segments], dtype="datetime64[ns]")
+
+    fields = [_segment_fields(seg, flight_id) for seg in segments]
+    kinds = [f[1] for f in fields]
+    irregularities = [f[2] for f in fields]
+    for i, (warnings, _, _) in enumerate(fields):
+        for check, message in warnings:
+            add(i, check, message)
+
+    def tagged(tag):
+        return np.array([has_irregularity(irr, tag) for irr in irregularities], dtype=bool)
+
+    # duplicates are reported at every occurrence but the first
+    if n > 0:
+        _, first_index, inverse = np.unique(segment_ids.astype(str), return_index=True, return_inverse=True)
+        for i in np.flatnonzero((first_index[inverse] != np.arange(n)) & (segment_ids != "")):
+            add(int(i), "segment_id", "segment_id \"{}\" is duplicated".format(segment_ids[i]))
+
+    for i in np.flatnonzero(ends <= starts):
+        add(int(i), "time", "segment ends before it starts")
+
+    for key, outside, message in [("takeoff", starts, "segment starts before takeoff"),
+                                  ("landing", ends, "segment ends after landing")]:
+        if flight.get(key) is None:
+            continue
+        t = np.datetime64(flight[key], "ns")
+        for i in np.flatnonzero(outside < t if key == "takeoff" else outside > t):
+            add(int(i), "time", message)
+
+    # a time may not belong to more than one segment of the same kind, see README
+    all_kinds = sorted(set(k for ks in kinds for k in ks if isinstance(k, str)))
+    for kind in all_kinds:
+        members = np.flatnonzero([kind in ks for ks in kinds])
+        members = members[np.argsort(starts[members], kind="stable")]
+        if len(members) < 2:
+            continue
+        previous = _running_argmax(ends[members])[:-1]
+        overlapping = starts[members[1:]] < ends[members][previous]
+        for i, j in zip(members[1:][overlapping], members[previous][overlapping]):
+            add(int(i), "overlap", "segment overlaps with segment \"{}\" of the same kind {}".format(
+                segment_ids[j], kind))
+
+    # sondes
+    platform_sondes = sonde_index[flight.get("platform", "")]
+    first, last = platform_sondes.windows(starts, ends)
+    sam = tagged("SAM")
+
+    flag_names = platform_sondes.flag_names
+    flag_codes = platform_sondes.flag_codes
+    n_sondes = len(platform_sondes)
+
+    # the sonde ids of every flag have to match in the order of sondes.yaml, flags without sondes are ignored
+    sonde_ids_by_flag = platform_sondes.sonde_ids_by_flag_windows(starts, ends)
+    for i, seg in enumerate(segments):
+        if not isinstance(seg.get("dropsondes"), dict) or sam[i]:
+            continue
+        listed = {flag: sonde_ids for flag, sonde_ids in seg["dropsondes"].items()
+                  if not isinstance(sonde_ids, list) or len(sonde_ids) > 0}
+        if listed != sonde_ids_by_flag[i]:
+            add(i, "sondes", "dropsondes in segment file are different from sondes in sondes.yaml and no SAM irregularity is recorded")
+
+    good = np.concatenate([[0], np.cumsum(flag_codes == flag_names.index("GOOD"))]) \
+           if "GOOD" in flag_names else np.zeros(n_sondes + 1, dtype="int64")
+    good_found = good[last] - good[first]
+    good_listed = np.array([len(seg["dropsondes"].get("GOOD", []))
+                            if isinstance(seg.get("dropsondes"), dict)
+                            else seg.get("good_dropsondes", 0)
+                            for seg in segments], dtype="int64")
+    for i in np.flatnonzero((good_listed != good_found) & ~sam):
+        add(int(i), "sondes", "inconsistent number of good sondes between segment file and sondes.yaml and no SAM irregularity is recorded")
+
+    circle = np.array(["circle" in ks for ks in kinds], dtype=bool)
+    with_sondes = circle & (last > first)
+    seconds_to_first_sonde = (platform_sondes.launch_times[first[with_sondes]] - starts[with_sondes]) \
+                           / np.timedelta64(1, "s")
+    # use a little bit more that .5 sec offset to cover rounding errors
+    late = np.abs(seconds_to_first_sonde - 60.) > .75
+    for i in np.flatnonzero(with_sondes)[late & ~tagged("TTFS")[with_sondes]]:
+        add(int(i), "sondes", "time to first sonde is not 1 minute and no TTFS irregularities are recorded")
+
+    # navdata, sliced once per segment by index
+    if navdata is not None:
+        time = navdata.time.values
+        nav_first = np.searchsorted(time, starts, side="left")
+        nav_last = np.searchsorted(time, ends, side="right")
+        for i in range(n):
+            seg_navdata = navdata.isel(time=slice(nav_first[i], nav_last[i]))
+            for message in check_navdata(kinds[i], irregularities[i], seg_navdata, starts[i], ends[i]):
+                add(i, "navdata", message)
+
+    # python's sort is stable, so warnings of a segment keep the order within each check
+    return sorted(table, key=lambda w: (-1 if w["segment"] is None else w["segment"],
+                                        CHECK_ORDER.index(w["check"])))
+
+
+def split_warnings(table, flight):
+    """
+    :returns: list of flight warnings and list of (segment_id, warnings) per segment
+    """
+    segments = flight.get("segments", [])
+    segment_warnings = [(seg.get("segment_id"), []) for seg in segments]
+    flight_warnings = []
+    for w in table:
+        if w["segment"] is None:
+            flight_warnings.append(w["message"])
+        else:
+            segment_warnings[w["segment"]][1].append(w["message"])
+    return flight_warnings, segment_warnings
+
+
 class FlightChecker:
+    """
+    checks a flight one segment after the other, like check_flight_batch
+
+    Unlike check_flight_batch, malformed kinds and irregularities are removed
+    from checked segments. Overlaps between segments and segments outside of
+    takeoff and landing are only found by check_flight_batch.
+    """
     def __init__(self, flight):
         self.used_segment_ids = set()
         self.flight_id = flight.get("flight_id", "")
+        self.platform = flight.get("platform", "")
 
     def check_flight(self, flight):
-        if "flight_id" not in flight:
-            yield "flight_id is missing"
-
-        if "platform" not in flight:
-            yield "platform is missing"
+        from sondeindex import SondeIndex
+        yield from split_warnings(check_flight_batch(dict(flight, segments=[]), None, SondeIndex([])), flight)[0]
 
     def check_segment(self, seg, navdata, sondes_by_flag):
+        """
+        :param navdata: navdata of the segment
+        :param sondes_by_flag: dict of flag to list of sondes launched within the segment
+        """
+        from sondeindex import SondeIndex
+        sonde_index = SondeIndex([dict(s, platform=self.platform)
+                                  for sondes in sondes_by_flag.values() for s in sondes])
+        flight = {"flight_id": self.flight_id, "platform": self.platform, "segments": [seg]}
+        warnings = [w["message"] for w in check_flight_batch(flight, navdata, sonde_index)
+                    if w["segment"] is not None]
         if "segment_id" in seg:
-            segment_id = seg["segment_id"]
-            if not segment_id.startswith(self.flight_id):
-                yield "segment_id does not start with flight_id"
-            if segment_id in self.used_segment_ids:
-                yield "segment_id \"{}\" is duplicated".format(segment_id)
-            self.used_segment_ids.add(segment_id)
-        else:
-            yield "segment_id is missing"
-
-        if "kinds" in seg:
-            kinds = seg["kinds"]
-            if not isinstance(kinds, list):
-                yield "kinds is not a list"
-                del seg["kinds"]
-            elif len(kinds) == 0:
-                yield "segment has no kinds"
-        else:
-            yield "segment has no kinds attribute"
-            kinds = []
-
-        if seg["end"] <= seg["start"]:
-            yield "segment ends before it starts"
-
-        if "irregularities" in seg:
-            irregularities = seg["irregularities"]
-            if not isinstance(irregularities, list):
-                yield "irregularities is not a list"
-                del seg["irregularities"]
-                irregularities = []
-            else:
-                if not all(isinstance(i, str) for i in irregularities):
-                    yield "irregularities is not a list of str"
-                    del seg["irregularities"]
-                    irregularities = []
-        else:
-            yield "segment has no irregularities attribute"
-            irregularities = []
-
-        good_dropsondes = 0
-        if "good_dropsondes" in seg:
-            yield "good_dropsondes attribute is deprecated. uses dropsondes instead"
-            good_dropsondes = seg["good_dropsondes"]
-
-        if "dropsondes" not in seg:
-            yield "dropsondes attribute is missing"
-        elif not isinstance(seg["dropsondes"], dict):
-            yield "dropsondes is not a mapping"
-        else:
-            for flag, sonde_ids in seg["dropsondes"].items():
-                if not isinstance(sonde_ids, list):
-                    yield "dropsondes with flag {} are not a list".format(flag)
-            good_dropsondes = len(seg["dropsondes"].get("GOOD", []))
-
-            dropsondes_from_info = {f: [s["sonde_id"] for s in sondes]
-                                    for f, sondes in sondes_by_flag.items()}
-            dropsondes_from_segment = {f: s
-                                       for f, s in seg["dropsondes"].items()
-                                       if len(s) > 0}
-            if dropsondes_from_segment != dropsondes_from_info and not has_irregularity(irregularities, "SAM"):
-                yield "dropsondes in segment file are different from sondes in sondes.yaml and no SAM irregularity is recorded"
-
-        sonde_times = list(sorted([s["launch_time"]
-                                   for sondes in sondes_by_flag.values()
-                                   for s in sondes]))
-
-        if good_dropsondes != len(sondes_by_flag.get("GOOD", [])) and not has_irregularity(irregularities, "SAM"):
-            yield "inconsistent number of good sondes between segment file and sondes.yaml and no SAM irregularity is recorded"
-
-        t_start = np.datetime64(seg["start"])
-        if "circle" in kinds and len(sonde_times) > 0:
-            seconds_to_first_sonde = (np.datetime64(sonde_times[0]) - t_start) \
-                                   / np.timedelta64(1, "s")
-            if abs(seconds_to_first_sonde - 60.) > .75 and not has_irregularity(irregularities, "TTFS"):
-                # use a little bit more that .5 sec offset to cover rounding errors
-                yield "time to first sonde is not 1 minute and no TTFS irregularities are recorded"
+            if seg["segment_id"] in self.used_segment_ids:
+                n_id_warnings = len([m for m in warnings if m.startswith("segment_id")])
+                warnings.insert(n_id_warnings, "segment_id \"{}\" is duplicated".format(seg["segment_id"]))
+            self.used_segment_ids.add(seg["segment_id"])
+        yield from warnings
+
+        if "kinds" in seg and not isinstance(seg["kinds"], list):
+            del seg["kinds"]
+        if "irregularities" in seg and not (isinstance(seg["irregularities"], list)
+                                            and all(isinstance(i, str) for i in seg["irregularities"])):
+            del seg["irregularities"]
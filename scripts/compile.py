@@ -1,5 +1,6 @@
 import sys
 import yaml
+from yamlload import load_yaml
 from collections import defaultdict
 
 
@@ -36,31 +37,176 @@ def sort_keys(d, priority=None):
     return dict([(k, d[k]) for k in ordered_keys])
 
 
+def compile_flights(flights):
+    """
+    :param flights: iterable of flights as read from segment files
+    :returns: dict of platform to dict of flight_id to flight, with keys and segments in canonical order
+    """
+    all_flights = defaultdict(dict)
+
+    for flight in flights:
+        all_flights[flight["platform"]][flight["flight_id"]] = sort_keys(
+                {**flight, "segments": list(sorted((sort_keys(seg, segment_key_priority) for seg in flight["segments"]),
+                                                   key=lambda seg: seg["start"]))},
+                flight_key_priority)
+
+    return sort_keys(dict(all_flights.items()))
+
+
+def kinds_of(all_flights):
+    return list(sorted(set(kind
+                           for flights in all_flights.values()
+                           for flight in flights.values()
+                           for seg in flight["segments"]
+                           for kind in seg.get("kinds") or [])))
+
+
+def to_columnar(all_flights, statistics=None):
+    """
+    converts compiled flights into tables of segments and flights
+
+    Kinds and irregularity tags are stored as bit masks following the CF
+    conventions for flags (flag_masks and flag_meanings attributes). Rows are
+    in the same order as in the compiled YAML output.
+
+    :param statistics: optional dict of flight_id to segment statistics (see
+                       segmentstats.py), added as segment variables matched by
+                       segment_id, missing values are NaN (or -1 for counts)
+    :returns: xarray.Dataset with a segment and a flight dimension
+    """
+    import numpy as np
+    import xarray as xr
+    from checkers import IRREGULARITY_TAGS, has_irregularity
+
+    kinds = kinds_of(all_flights)
+    kind_masks = {k: 1 << i for i, k in enumerate(kinds)}
+    tag_masks = {t: 1 << i for i, t in enumerate(IRREGULARITY_TAGS)}
+    sonde_flags = ["GOOD", "BAD", "UGLY"]
+
+    def to_time(t):
+        return np.datetime64(t, "ns") if t is not None else np.datetime64("NaT", "ns")
+
+    segments = {k: [] for k in ["segment_id", "segment_name", "segment_flight_id", "segment_platform",
+                                "start", "end", "kinds", "irregularity_tags", "n_irregularities"] +
+                               ["n_sondes_" + flag for flag in sonde_flags]}
+    flights = {k: [] for k in ["flight_id", "flight_name", "platform", "takeoff", "landing",
+                               "first_segment", "n_segments"]}
+
+    for platform, platform_flights in all_flights.items():
+        for flight_id, flight in platform_flights.items():
+            flights["flight_id"].append(flight_id)
+            flights["flight_name"].append(flight.get("name", ""))
+            flights["platform"].append(platform)
+            flights["takeoff"].append(to_time(flight.get("takeoff")))
+            flights["landing"].append(to_time(flight.get("landing")))
+            flights["first_segment"].append(len(segments["segment_id"]))
+            flights["n_segments"].append(len(flight["segments"]))
+
+            for seg in flight["segments"]:
+                irregularities = seg.get("irregularities") or []
+                dropsondes = seg.get("dropsondes") or {}
+                segments["segment_id"].append(seg.get("segment_id", ""))
+                segments["segment_name"].append(seg.get("name", ""))
+                segments["segment_flight_id"].append(flight_id)
+                segments["segment_platform"].append(platform)
+                segments["start"].append(to_time(seg["start"]))
+                segments["end"].append(to_time(seg["end"]))
+                segments["kinds"].append(sum(kind_masks[k] for k in set(seg.get("kinds") or [])))
+                segments["irregularity_tags"].append(sum(mask
+                                                         for tag, mask in tag_masks.items()
+                                                         if has_irregularity(irregularities, tag)))
+                segments["n_irregularities"].append(len(irregularities))
+                for flag in sonde_flags:
+                    segments["n_sondes_" + flag].append(len(dropsondes.get(flag) or []))
+
+    string_vars = {"segment_id", "segment_name", "segment_flight_id", "segment_platform",
+                   "flight_id", "flight_name", "platform"}
+    time_vars = {"start", "end", "takeoff", "landing"}
+
+    def to_array(name, values):
+        if name in string_vars:
+            return np.array(values, dtype=object)
+        if name in time_vars:
+            return np.array(values, dtype="datetime64[ns]")
+        return np.array(values, dtype="int64")
+
+    ds = xr.Dataset({
+        **{name: ("segment", to_array(name, values)) for name, values in segments.items()},
+        **{name: ("flight", to_array(name, values)) for name, values in flights.items()},
+    })
+    ds.kinds.attrs.update({
+        "flag_masks": np.array(list(kind_masks.values()), dtype="int64"),
+        "flag_meanings": " ".join(kinds),
+    })
+    ds.irregularity_tags.attrs.update({
+        "flag_masks": np.array(list(tag_masks.values()), dtype="int64"),
+        "flag_meanings": " ".join(IRREGULARITY_TAGS),
+    })
+    if statistics:
+        add_statistics(ds, statistics)
+    return ds
+
+
+def add_statistics(ds, statistics):
+    """
+    adds segment statistics of flights to the segment table ds
+    """
+    import numpy as np
+
+    rows = {}
+    for i, key in enumerate(zip(ds.segment_flight_id.values.tolist(), ds.segment_id.values.tolist())):
+        rows.setdefault(key, i)
+
+    for flight_id, stats in statistics.items():
+        source_rows, target_rows = [], []
+        for j, segment_id in enumerate(stats.segment_id.values.tolist()):
+            if (flight_id, segment_id) in rows:
+                source_rows.append(j)
+                target_rows.append(rows[(flight_id, segment_id)])
+        for name, var in stats.data_vars.items():
+            if name == "segment_id":
+                continue
+            if name not in ds:
+                fill = -1 if var.dtype.kind in "iu" else np.nan
+                ds[name] = ("segment", np.full(ds.sizes["segment"], fill, dtype=var.dtype))
+                ds[name].attrs.update(var.attrs)
+            ds[name].values[target_rows] = var.values[source_rows]
+
+
 def _main():
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("infiles", type=str, nargs="+")
     parser.add_argument("-o", "--outfile", type=str)
+    parser.add_argument("--netcdf", type=str,
+                        help="also write the catalog as columnar netCDF tables, "
+                             "the YAML output is skipped if no outfile is given")
+    parser.add_argument("--statistics", metavar="DIR",
+                        help="add the segment statistics written by verify.py --statistics to the netCDF tables")
 
     args = parser.parse_args()
 
-    all_flights = defaultdict(dict)
+    all_flights = compile_flights(load_yaml(filename) for filename in args.infiles)
 
-    for filename in args.infiles:
-        with open(filename) as f:
-            flight = yaml.load(f, Loader=yaml.SafeLoader)
-        all_flights[flight["platform"]][flight["flight_id"]] = sort_keys(
-                {**flight, "segments": list(sorted((sort_keys(seg, segment_key_priority) for seg in flight["segments"]),
-                                                   key=lambda seg: seg["start"]))},
-                flight_key_priority)
+    if args.netcdf:
+        statistics = None
+        if args.statistics:
+            from segmentstats import load_statistics
+            statistics = {flight_id: load_statistics(args.statistics, flight_id)
+                          for flights in all_flights.values()
+                          for flight_id in flights}
+            statistics = {flight_id: stats for flight_id, stats in statistics.items() if stats is not None}
+        to_columnar(all_flights, statistics).to_netcdf(args.netcdf)
+        if not args.outfile:
+            return 0
 
     if args.outfile:
         outfile = open(args.outfile, "w")
     else:
         outfile = sys.stdout
 
-    yaml.dump(sort_keys(dict(all_flights.items())), outfile, allow_unicode=True, sort_keys=False)
+    yaml.dump(all_flights, outfile, allow_unicode=True, sort_keys=False)
 
     return 0
 
@@ -0,0 +1,231 @@
+# proposes flight segments from navdata
+#
+# the detector classifies every sample as straight, turning left, turning
+# right or other, based on rolling statistics of roll angle, heading rate and
+# altitude rate. Runs of equal state are turned into candidate segments and
+# their boundaries are snapped to roll-in and roll-out. Everything is done in
+# vectorized passes over the flight, only the (few) runs are handled in Python.
+
+import numpy as np
+
+SMOOTHING = np.timedelta64(20, "s")
+
+MAX_LEVEL_ALT_RATE = 2.  # m/s
+MAX_STRAIGHT_ROLL = 1.5  # deg
+MAX_STRAIGHT_HEADING_RATE = .05  # deg/s
+MIN_TURN_ROLL = 1.5  # deg
+MAX_TURN_ROLL = 8.  # deg
+ROLL_IN_FRACTION = .8  # fraction of typical roll during a turn at which roll-in is complete
+
+MIN_STRAIGHT_LEG_DURATION = np.timedelta64(3, "m")
+MIN_TURN_DURATION = np.timedelta64(5, "m")
+MAX_GAP = np.timedelta64(30, "s")  # merge runs of equal state interrupted by at most this long
+
+MIN_CIRCLE_HEADING_CHANGE = 300.  # deg
+MAX_CIRCLE_HEADING_CHANGE = 420.  # deg, longer turns are "circling"
+
+OTHER, STRAIGHT, TURN_LEFT, TURN_RIGHT = range(4)
+
+
+def rolling_mean(x, n):
+    """
+    centered rolling mean over n samples, shrinking towards the edges
+
+    Non-finite samples are left out, the mean is NaN where the window has no finite sample.
+    """
+    n = max(int(n), 1)
+    valid = np.isfinite(x)
+    c = np.concatenate([[0.], np.cumsum(np.where(valid, x, 0.))])
+    k = np.concatenate([[0], np.cumsum(valid)])
+    i = np.arange(len(x))
+    lo = np.clip(i - n // 2, 0, len(x))
+    hi = np.clip(i - n // 2 + n, 0, len(x))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (c[hi] - c[lo]) / (k[hi] - k[lo])
+
+
+def fill_gaps(x, seconds):
+    """
+    :returns: x with non-finite samples interpolated linearly between the neighbouring finite samples
+    """
+    finite = np.isfinite(x)
+    if finite.all() or not finite.any():
+        return x
+    return np.interp(seconds, seconds[finite], x[finite])
+
+
+def gradient(x, seconds):
+    """
+    np.gradient along seconds, samples with a repeated timestamp get the gradient of the first one
+    """
+    first = np.concatenate([[True], np.diff(seconds) > 0])
+    if np.count_nonzero(first) < 2:
+        return np.zeros(len(x))
+    if first.all():
+        return np.gradient(x, seconds)
+    return np.gradient(x[first], seconds[first])[np.cumsum(first) - 1]
+
+
+def classify(time, roll, heading, alt):
+    """
+    :returns: (state per sample, unwrapped heading, seconds since first sample)
+    """
+    seconds = (time - time[0]) / np.timedelta64(1, "s")
+    steps = np.diff(seconds)
+    dt = np.median(steps[steps > 0]) if np.any(steps > 0) else 1.
+    n = SMOOTHING / np.timedelta64(1, "s") / dt
+
+    # single missing samples must not stop the detection, unwrap would carry them forward
+    heading = np.rad2deg(np.unwrap(np.deg2rad(fill_gaps(heading, seconds))))
+    heading_rate = rolling_mean(gradient(heading, seconds), n)
+    alt_rate = rolling_mean(gradient(fill_gaps(alt, seconds), seconds), n)
+    roll_mean = rolling_mean(roll, n)
+
+    level = np.abs(alt_rate) < MAX_LEVEL_ALT_RATE
+    straight = level & (np.abs(roll_mean) < MAX_STRAIGHT_ROLL) \
+                     & (np.abs(heading_rate) < MAX_STRAIGHT_HEADING_RATE)
+    turning = level & (np.abs(roll_mean) >= MIN_TURN_ROLL) & (np.abs(roll_mean) <= MAX_TURN_ROLL) \
+                    & (np.sign(roll_mean) == np.sign(heading_rate))
+
+    state = np.full(len(time), OTHER, dtype="int8")
+    state[straight] = STRAIGHT
+    state[turning & (roll_mean < 0)] = TURN_LEFT
+    state[turning & (roll_mean > 0)] = TURN_RIGHT
+    return state, heading, seconds
+
+
+def runs_of(state):
+    """
+    :returns: arrays of state, first index and last index (exclusive) of runs of equal state
+    """
+    if len(state) == 0:
+        return np.zeros(0, dtype=state.dtype), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    change = np.flatnonzero(np.diff(state)) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [len(state)]])
+    return state[starts], starts, ends
+
+
+def merge_runs(runs, time):
+    """
+    merges runs of equal state which are separated by short runs of other states
+    """
+    merged = []
+    for s, a, b in zip(*runs):
+        if s == OTHER:
+            continue
+        if merged and merged[-1][0] == s and time[a] - time[merged[-1][2] - 1] <= MAX_GAP:
+            merged[-1][2] = b
+        else:
+            merged.append([s, a, b])
+    return merged
+
+
+def to_datetime(t, rounding):
+    seconds = t.astype("datetime64[s]")
+    if rounding == "up" and seconds < t:
+        seconds += np.timedelta64(1, "s")
+    return seconds.item()
+
+
+def detect_segments(navdata):
+    """
+    :param navdata: navdata with time, roll, heading and alt
+    :returns: list of (kind, start, end) with start and end as datetime64, sorted by start
+    """
+    time = navdata.time.values
+    roll = navdata["roll"].values.astype("float64")
+    state, heading, seconds = classify(time, roll,
+                                       navdata["heading"].values.astype("float64"),
+                                       navdata["alt"].values.astype("float64"))
+
+    candidates = []
+    for s, a, b in merge_runs(runs_of(state), time):
+        duration = time[b - 1] - time[a]
+        if s == STRAIGHT:
+            if duration < MIN_STRAIGHT_LEG_DURATION:
+                continue
+            # snap to the first and last wings level sample
+            level = np.flatnonzero(np.abs(roll[a:b]) < MAX_STRAIGHT_ROLL)
+            if len(level) == 0:
+                continue
+            candidates.append(("straight_leg", time[a + level[0]], time[a + level[-1]]))
+        else:
+            if duration < MIN_TURN_DURATION:
+                continue
+            # snap to the end of roll-in and the start of roll-out
+            bank = np.abs(roll[a:b])
+            banked = np.flatnonzero(bank >= ROLL_IN_FRACTION * np.nanmedian(bank))
+            if len(banked) == 0:
+                continue
+            first, last = a + banked[0], a + banked[-1]
+            heading_change = abs(heading[last] - heading[first])
+            if heading_change < MIN_CIRCLE_HEADING_CHANGE:
+                continue
+            kind = "circle" if heading_change <= MAX_CIRCLE_HEADING_CHANGE else "circling"
+            candidates.append((kind, time[first], time[last]))
+
+    return list(sorted(candidates, key=lambda c: c[1]))
+
+
+def draft_flight(navdata, flight_id, platform):
+    """
+    :returns: flight dict with proposed segments, keys in the order used by compile.py
+    """
+    from compile import sort_keys, segment_key_priority, flight_key_priority
+
+    prefixes = {"straight_leg": "l", "circle": "c", "circling": "cc"}
+    counts = {}
+    segments = []
+    for kind, start, end in detect_segments(navdata):
+        counts[kind] = counts.get(kind, 0) + 1
+        segments.append(sort_keys({
+            "segment_id": "{}_{}{}".format(flight_id, prefixes[kind], counts[kind]),
+            "name": "{} {}".format(kind.replace("_", " "), counts[kind]),
+            "start": to_datetime(start, "up"),
+            # the end is not part of the segment, so the last detected sample is included
+            "end": to_datetime(end + np.timedelta64(1, "s"), "down"),
+            "kinds": [kind],
+            "irregularities": [],
+        }, segment_key_priority))
+
+    return sort_keys({
+        "flight_id": flight_id,
+        "platform": platform,
+        "segments": segments,
+    }, flight_key_priority)
+
+
+def _main():
+    import sys
+    import time
+    import argparse
+    import yaml
+    from navdata import get_navdata
+    from navcache import add_cache_arguments, cache_from_args
+
+    parser = argparse.ArgumentParser(description="propose flight segments from navdata")
+    parser.add_argument("platform")
+    parser.add_argument("flight_id")
+    parser.add_argument("-o", "--outfile", help="draft segment file, defaults to stdout")
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    navdata = get_navdata(args.platform, args.flight_id, cache=cache_from_args(args)).load()
+
+    t0 = time.perf_counter()
+    flight = draft_flight(navdata, args.flight_id, args.platform)
+    print("detected {} segments in {:.3f} s".format(len(flight["segments"]), time.perf_counter() - t0),
+          file=sys.stderr)
+
+    if args.outfile:
+        with open(args.outfile, "w") as outfile:
+            yaml.dump(flight, outfile, allow_unicode=True, sort_keys=False)
+    else:
+        yaml.dump(flight, sys.stdout, allow_unicode=True, sort_keys=False)
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(_main())
@@ -0,0 +1,53 @@
+# single entry point for the scripts
+#
+#   python3 scripts/flightseg.py verify flight_segment_files/*.yaml
+#
+# only the module of the chosen subcommand is imported, which in turn imports
+# heavy dependencies (xarray, matplotlib, ...) only where they are needed, so
+# e.g. `flightseg verify --schema-only` or `--help` start quickly.
+
+import os
+import sys
+import importlib
+
+# subcommand: (module, description)
+COMMANDS = {
+    "verify": ("verify", "check segment files against navdata and sondes"),
+    "report": ("report", "create HTML reports of flights"),
+    "compile": ("compile", "compile segment files into one catalog"),
+    "attach-sondes": ("utils.attach_sondes", "attach dropsonde ids to segment files"),
+    "detect": ("detect", "propose flight segments from navdata"),
+    "prefetch": ("prefetch", "prefetch navdata of many flights"),
+    "query": ("segmentindex", "query the segments of a compiled catalog by time"),
+    "synthetic": ("synthetic", "write segment files and sondes of synthetic flights"),
+    "benchmark": ("benchmark", "benchmark the stages of the scripts on synthetic flights"),
+}
+
+
+def usage():
+    width = max(map(len, COMMANDS))
+    return "usage: flightseg <command> [options]\n\ncommands:\n" + \
+           "\n".join("  {:<{}}  {}".format(name, width, description)
+                     for name, (_, description) in COMMANDS.items()) + \
+           "\n\nuse flightseg <command> --help for the options of a command"
+
+
+def _main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        return 0
+    command = sys.argv[1]
+    if command not in COMMANDS:
+        print("unknown command {}\n\n{}".format(command, usage()), file=sys.stderr)
+        return 2
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    if scripts_dir not in sys.path:
+        sys.path.insert(0, scripts_dir)
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = ["flightseg " + command] + sys.argv[2:]
+    return module._main()
+
+
+if __name__ == "__main__":
+    exit(_main())
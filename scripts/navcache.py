@@ -0,0 +1,175 @@
+# persistent on-disk caches for reduced navdata and derived products
+#
+# entries are content addressed: the key is derived from the platform, the
+# flight id, the id of the data source (e.g. the IPFS CID) and the version of
+# the postprocessing which has been applied. If any of these change, a new
+# entry is created and the old one eventually drops out by LRU eviction.
+
+import os
+import abc
+import hashlib
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def default_cache_dir(kind="navdata"):
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "flight_segmentation", kind)
+
+
+def cache_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def update_dataset_hash(h, ds):
+    """
+    feeds names and contents of all variables of ds into the hash h
+    """
+    import numpy as np
+    for name in sorted(ds.variables):
+        h.update(str(name).encode("utf-8"))
+        h.update(b"\0")
+        h.update(np.ascontiguousarray(ds[name].values).tobytes())
+
+
+def file_fingerprint(*filenames):
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class FileCache(abc.ABC):
+    suffix = ""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir: directory to store cached entries in
+        :param max_bytes: total size of the cache after which least recently used entries are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """
+        :returns: cached value or None if the key is not cached
+        """
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return self.read(path)
+
+    def put(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path_for(key)
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            self.write(tmppath, value)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        self.evict(keep=path)
+        return path
+
+    @abc.abstractmethod
+    def read(self, path):
+        """
+        :returns: value stored in the entry at path
+        """
+
+    @abc.abstractmethod
+    def write(self, path, value):
+        """
+        stores value at path, which is moved into place by put
+        """
+
+    def entries(self):
+        """
+        :returns: list of (mtime, size, path) of all cache entries, least recently used first
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return list(sorted(entries))
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class NavdataCache(FileCache):
+    suffix = ".nc"
+    time_chunk_size = 2**15
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        super().__init__(cache_dir, max_bytes)
+
+    def read(self, path):
+        import xarray as xr
+        return xr.open_dataset(path)
+
+    def write(self, path, ds):
+        # chunks along time allow reading only parts of the flight, see navdata.load_windows
+        encoding = {var: {"zlib": True, "complevel": 4,
+                          "chunksizes": tuple(min(n, self.time_chunk_size) if d == "time" else n
+                                              for d, n in zip(ds[var].dims, ds[var].shape))}
+                    for var in ds.data_vars}
+        ds.to_netcdf(path, encoding=encoding)
+
+
+class PickleCache(FileCache):
+    suffix = ".pkl"
+
+    def read(self, path):
+        import pickle
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def write(self, path, value):
+        import pickle
+        with open(path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", help="directory for cached navdata", default=default_cache_dir())
+    parser.add_argument("--no-cache", help="don't use the local navdata cache", action="store_true")
+
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    return NavdataCache(args.cache_dir)
+
+__all__ = ["NavdataCache", "PickleCache", "add_cache_arguments", "cache_from_args"]
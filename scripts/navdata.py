@@ -1,48 +1,295 @@
-# the individual loaders should import dependencies within the function
-# that way it is possible to run the code for one platform if dependencies
-# for another platform are not met
+# navdata of a platform is provided by a backend, which platform uses which
+# backend (and e.g. the mapping of flights to data sources) is configured in
+# navdata_sources.yaml. Backends import their dependencies within their
+# methods, that way it is possible to run the code for one platform if
+# dependencies for another platform are not met. Additional backends can be
+# provided by other packages through the entry point group below.
 
-_catalog_cache = {}
+import os
+import abc
 
-def get_navdata_HALO(flight):
+SOURCES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "navdata_sources.yaml")
+SOURCES_ENV = "FLIGHT_SEGMENTATION_NAVDATA_SOURCES"
+ENTRY_POINT_GROUP = "flight_segmentation.navdata_backends"
+
+# navdata variables provided by all backends
+NAVDATA_VARIABLES = ["lat", "lon", "alt", "roll", "pitch", "heading"]
+
+
+def _package_version(name):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+class NavdataBackend(abc.ABC):
+    def __init__(self, platform, options, basedir):
+        """
+        :param options: options of the platform in the sources file
+        :param basedir: directory of the sources file, relative paths start there
+        """
+        self.platform = platform
+        self.options = options
+        self.basedir = basedir
+
+    @abc.abstractmethod
+    def get(self, flight):
+        """
+        :returns: navdata of the flight, possibly lazily loaded
+        """
+
+    def source_id(self, flight):
+        """
+        :returns: tuple identifying the data source and postprocessing of the flight,
+                  or None if the navdata should not be cached
+        """
+        return None
+
+    def ipfs_source(self, flight):
+        """
+        :returns: (cid, variables, store_dir) of a zarr store on IPFS holding the navdata, or None,
+                  store_dir is the directory of prefetched stores or None for the default
+        """
+        return None
+
+
+NAVDATA_BACKENDS = {}
+
+
+def navdata_backend(name):
     """
-    :param flight: flight id
+    registers a NavdataBackend under the given name
     """
-    import xarray as xr
-    from intake import open_catalog
-    import orcestra.postprocess.level0
-
-    bahamas_cids = {
-        "HALO-20240809b": "QmahYozz3StbbeJxXn7zPycdZYz6mLVNYszEU28XqxSMGc",
-        "HALO-20240811a": "QmbmtXr3pSGexuteUAcasgAzSHHpfKNXk9r5JfZXKqa2d5",
-        "HALO-20240813a": "QmcFHpX6zNcG7kFjUNff8BEUkoYomwpnTJUAjhXq9KACtg",
-        "HALO-20240816a": "QmTCph5sHoq9pcXLHyHix2qAVmSCBjvLmbPCfx2QgVs13a",
-        "HALO-20240818a": "QmSjsEFDywceEDLxs2zHfcj1GuRATDosgw9fwsFT5bAX8x",
-        "HALO-20240821a": "QmXnuuipS3xFE3mX7ZGRti55NapwSRVsBMPDfvnTMkSLoj",
-        "HALO-20240822a": "QmethFGpJ5jg8ASnS3kcQPDN6bct4g85DBh2HWQQqj7DXb",
-    }
-
-    ds = xr.open_dataset(f"ipfs://{bahamas_cids[flight]}", engine="zarr").pipe(orcestra.postprocess.level0.bahamas)
-    print(ds)
-    return xr.Dataset({
-        "time": ds.time,
-        "lat": ds.IRS_LAT,
-        "lon": ds.IRS_LON,
-        "alt": ds.IRS_ALT,
-        "roll": ds.IRS_PHI,
-        "pitch": ds.IRS_THE,
-        "heading": ds.IRS_HDG,
-    })
-
-NAVDATA_GETTERS = {
-    "HALO": get_navdata_HALO,
-}
-
-def get_navdata(platform, flight):
+    def register(cls):
+        NAVDATA_BACKENDS[name] = cls
+        return cls
+    return register
+
+
+@navdata_backend("ipfs_bahamas")
+class BahamasIPFSBackend(NavdataBackend):
+    """
+    BAHAMAS zarr stores on IPFS
+
+    options: flights (mapping of flight id to CID) and store_dir (optional
+    directory of stores prefetched by prefetch.py, relative paths start at the sources file)
+    """
+    def store_dir(self):
+        store_dir = self.options.get("store_dir")
+        if store_dir is None:
+            return None
+        return os.path.join(self.basedir, os.path.expanduser(store_dir))
+
+    def ipfs_source(self, flight):
+        from prefetch import BAHAMAS_VARIABLES
+        return self.options["flights"][flight], BAHAMAS_VARIABLES, self.store_dir()
+
+    def source_id(self, flight):
+        return "ipfs://{}".format(self.options["flights"][flight]), \
+               "orcestra=={}".format(_package_version("orcestra"))
+
+    def get(self, flight):
+        import xarray as xr
+        import orcestra.postprocess.level0
+        from prefetch import local_store
+
+        cid = self.options["flights"][flight]
+        # use the copy of prefetch.py if available
+        ds = xr.open_dataset(local_store(cid, self.store_dir()) or f"ipfs://{cid}", engine="zarr").pipe(orcestra.postprocess.level0.bahamas)
+        return xr.Dataset({
+            "time": ds.time,
+            "lat": ds.IRS_LAT,
+            "lon": ds.IRS_LON,
+            "alt": ds.IRS_ALT,
+            "roll": ds.IRS_PHI,
+            "pitch": ds.IRS_THE,
+            "heading": ds.IRS_HDG,
+        })
+
+
+@navdata_backend("local")
+class LocalBackend(NavdataBackend):
+    """
+    netCDF files or zarr stores in a directory
+
+    options: path (directory), pattern (file name, default "{flight}.nc") and
+    variables (optional mapping of navdata variables to variables in the files)
+    """
+    def filename(self, flight):
+        return os.path.join(self.basedir, os.path.expanduser(self.options["path"]),
+                            self.options.get("pattern", "{flight}.nc").format(flight=flight))
+
+    def source_id(self, flight):
+        filename = self.filename(flight)
+        st = os.stat(filename)
+        return "file://{}".format(os.path.abspath(filename)), st.st_mtime_ns, st.st_size
+
+    def get(self, flight):
+        import xarray as xr
+        filename = self.filename(flight)
+        engine = "zarr" if filename.rstrip("/").endswith(".zarr") else None
+        ds = xr.open_dataset(filename, engine=engine)
+        variables = self.options.get("variables", {})
+        return xr.Dataset({var: ds[variables.get(var, var)] for var in NAVDATA_VARIABLES})
+
+
+@navdata_backend("synthetic")
+class SyntheticBackend(NavdataBackend):
+    """
+    synthetic flights, see synthetic.py, flight ids end in the date of the flight (e.g. SYNTHETIC-20240801a)
+
+    options: any keyword argument of synthetic.synthetic_flight
+    """
+    def source_id(self, flight):
+        return None  # generating is faster than caching
+
+    def get(self, flight):
+        from synthetic import synthetic_flight, takeoff_of
+        navdata, _, _ = synthetic_flight(flight, takeoff_of(flight), platform=self.platform, **self.options)
+        return navdata
+
+
+_sources = None
+
+
+def navdata_sources():
+    """
+    :returns: dict of platform to (options, basedir) from all sources files
+    """
+    global _sources
+    if _sources is None:
+        from yamlload import load_yaml
+        filenames = [SOURCES_FILE] + [f for f in os.environ.get(SOURCES_ENV, "").split(os.pathsep) if f]
+        _sources = {}
+        for filename in filenames:
+            basedir = os.path.dirname(os.path.abspath(filename))
+            # small files read once per process, not worth a cache entry outside of --cache-dir
+            for platform, options in (load_yaml(filename, cache=False) or {}).items():
+                _sources[platform] = (options, basedir)
+    return _sources
+
+
+def _backend_class(name):
+    if name not in NAVDATA_BACKENDS:
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            if entry_point.name == name:
+                NAVDATA_BACKENDS[name] = entry_point.load()
+                break
+        else:
+            raise KeyError("unknown navdata backend {}".format(name))
+    return NAVDATA_BACKENDS[name]
+
+
+_backends = {}
+
+
+def get_backend(platform):
+    """
+    :returns: NavdataBackend configured for the platform
+    """
+    if platform not in _backends:
+        sources = navdata_sources()
+        if platform not in sources:
+            raise KeyError("no navdata source for platform {}".format(platform))
+        options, basedir = sources[platform]
+        options = dict(options)
+        _backends[platform] = _backend_class(options.pop("backend"))(platform, options, basedir)
+    return _backends[platform]
+
+
+# getters registered at runtime, e.g. for in-memory navdata, take precedence
+# over the sources files
+NAVDATA_GETTERS = {}
+NAVDATA_SOURCE_IDS = {}
+
+
+def get_navdata(platform, flight, cache=None):
     """
     :param platform: platform id
     :param flight: flight id
+    :param cache: optional NavdataCache, used to store and retrieve the reduced navdata
     """
-    return NAVDATA_GETTERS[platform](flight)
+    if platform in NAVDATA_GETTERS:
+        get = NAVDATA_GETTERS[platform]
+        source_id = NAVDATA_SOURCE_IDS.get(platform, lambda flight: None)
+    else:
+        backend = get_backend(platform)
+        get = backend.get
+        source_id = backend.source_id
+
+    source = source_id(flight) if cache is not None else None
+    if source is None:
+        return get(flight)
+
+    from navcache import cache_key
+    key = cache_key(platform, flight, *source)
+    ds = cache.get(key)
+    if ds is None:
+        cache.put(key, get(flight))
+        ds = cache.get(key)
+    return ds
+
+
+def time_chunk_size(ds):
+    """
+    :returns: chunk size along time of the data variables of ds or None if unknown
+    """
+    for var in ds.data_vars.values():
+        if "time" not in var.dims:
+            continue
+        axis = var.dims.index("time")
+        if var.chunks is not None:
+            return var.chunks[axis][0]
+        chunks = var.encoding.get("chunks") or var.encoding.get("chunksizes")
+        if chunks is not None:
+            return chunks[axis]
+    return None
+
+
+def merge_windows(times, windows, chunk_size=None):
+    """
+    :param times: sorted time coordinate
+    :param windows: list of (start, end) times, both ends included as in .sel(time=slice(start, end))
+    :param chunk_size: if given, ranges are extended to chunk boundaries
+    :returns: sorted, non-overlapping list of (first, last) index ranges covering all windows
+    """
+    import numpy as np
+    if len(windows) == 0:
+        return []
+    starts = np.searchsorted(times, np.array([w[0] for w in windows], dtype=times.dtype), side="left")
+    ends = np.searchsorted(times, np.array([w[1] for w in windows], dtype=times.dtype), side="right")
+    if chunk_size is not None:
+        starts = starts // chunk_size * chunk_size
+        ends = np.minimum(-(-ends // chunk_size) * chunk_size, len(times))
+
+    ranges = []
+    for start, end in sorted(zip(starts.tolist(), ends.tolist())):
+        if start >= end:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [tuple(r) for r in ranges]
+
+
+def load_windows(ds, windows):
+    """
+    loads only the parts of a lazy dataset which are covered by windows
+
+    Windows are merged and extended to whole chunks, such that every chunk
+    is fetched at most once.
+
+    :param ds: lazily opened navdata
+    :param windows: list of (start, end) times
+    """
+    import xarray as xr
+    ranges = merge_windows(ds.time.values, windows, time_chunk_size(ds))
+    if len(ranges) == 0:
+        return ds.isel(time=slice(0, 0)).load()
+    return xr.concat([ds.isel(time=slice(start, end)).load() for start, end in ranges], dim="time")
 
-__all__ = ["get_navdata"]
+__all__ = ["get_navdata", "get_backend", "navdata_backend", "NavdataBackend", "load_windows"]
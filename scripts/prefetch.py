@@ -0,0 +1,472 @@
+# concurrent prefetch of navdata sources into a local store
+#
+# the BAHAMAS data of HALO is published as zarr stores on IPFS. Opening them
+# with xarray fetches one flight after the other, so the network latency adds
+# up over a campaign. The prefetcher fetches only the variables needed for the
+# navdata of many flights concurrently (with a bounded number of connections
+# and retries) and writes them as local zarr stores, keyed by CID.
+# the ipfs_bahamas navdata backend reads from that store if the CID is present.
+#
+# the source of the stores is a "gateway", either an HTTP IPFS gateway or a
+# local directory containing one subdirectory per CID, which can be used to
+# run offline or to test against mirrored data. Chunks missing from a store
+# are only left out (i.e. read as fill value) if the gateway lists the
+# directory and the chunk is not listed, otherwise the copy stays incomplete.
+
+import os
+import sys
+import json
+import asyncio
+
+DEFAULT_GATEWAY = "https://ipfs.io/ipfs/"
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_RETRIES = 4
+
+# variables of the BAHAMAS stores used by the ipfs_bahamas navdata backend,
+# coordinates of these variables are fetched as well. The time axis TIME is
+# not a dimension coordinate (the dimension is tid), hence listed explicitly.
+BAHAMAS_VARIABLES = ["TIME", "IRS_LAT", "IRS_LON", "IRS_ALT", "IRS_PHI", "IRS_THE", "IRS_HDG"]
+
+
+class FetchError(Exception):
+    pass
+
+
+def default_store_dir():
+    from navcache import default_cache_dir
+    return default_cache_dir("ipfs")
+
+
+def local_store(cid, store_dir=None):
+    """
+    :returns: path of the local copy of cid if it has been prefetched completely, otherwise None
+    """
+    path = os.path.join(store_dir or default_store_dir(), cid)
+    # .zmetadata is written last, so its presence marks a complete copy
+    if os.path.exists(os.path.join(path, ".zmetadata")):
+        return path
+    return None
+
+
+def ipfs_source(platform, flight):
+    """
+    :returns: (cid, variables, store_dir) of the zarr store holding the navdata of a flight or None
+    """
+    from navdata import get_backend
+    try:
+        return get_backend(platform).ipfs_source(flight)
+    except KeyError:
+        return None
+
+
+class DirectoryGateway:
+    """
+    serves stores from a local directory with one subdirectory per CID
+    """
+    def __init__(self, root):
+        self.root = root
+
+    async def get(self, path):
+        """
+        :returns: content of path or None if it doesn't exist
+        """
+        filename = os.path.join(self.root, *path.split("/"))
+        try:
+            with open(filename, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def listing(self, path):
+        """
+        :returns: names within directory path, None if they are unknown
+        """
+        try:
+            return set(os.listdir(os.path.join(self.root, *path.split("/"))))
+        except FileNotFoundError:
+            return None
+
+    async def close(self):
+        pass
+
+
+class HTTPGateway:
+    """
+    serves stores from an IPFS HTTP gateway, e.g. https://ipfs.io/ipfs/
+    """
+    def __init__(self, url, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=60):
+        import aiohttp
+        self.url = url if url.endswith("/") else url + "/"
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def get(self, path):
+        async with self.session.get(self.url + path) as response:
+            if response.status == 404:
+                return None
+            if response.status == 429 or response.status >= 500:
+                raise FetchError("{} returned HTTP {}".format(path, response.status))
+            response.raise_for_status()
+            return await response.read()
+
+    async def listing(self, path):
+        # a 404 could as well be a transient failure of the gateway
+        return None
+
+    async def close(self):
+        await self.session.close()
+
+
+def open_gateway(gateway, max_connections=DEFAULT_MAX_CONNECTIONS):
+    if gateway.startswith("http://") or gateway.startswith("https://"):
+        return HTTPGateway(gateway, max_connections)
+    if gateway.startswith("file://"):
+        gateway = gateway[len("file://"):]
+    return DirectoryGateway(gateway)
+
+
+def chunk_keys(zarray):
+    """
+    :returns: keys of all chunks of a zarr v2 array relative to the array
+    """
+    import itertools
+    separator = zarray.get("dimension_separator") or "."
+    counts = [-(-n // c) for n, c in zip(zarray["shape"], zarray["chunks"])]
+    if len(counts) == 0:
+        return ["0"]
+    return [separator.join(map(str, index)) for index in itertools.product(*map(range, counts))]
+
+
+class Prefetcher:
+    def __init__(self, gateway, store_dir=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 retries=DEFAULT_RETRIES, backoff=.5):
+        """
+        :param gateway: object with async get(path) and close(), see open_gateway
+        :param store_dir: directory of the local stores, defaults to the directory configured for the
+                          navdata source or default_store_dir()
+        :param max_connections: maximum number of concurrent requests
+        :param retries: number of retries of a failed request
+        :param backoff: seconds to wait before the first retry, doubled for every further retry
+        """
+        self.gateway = gateway
+        self.store_dir = store_dir
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.retries = retries
+        self.backoff = backoff
+        self.n_bytes = 0
+
+    async def get(self, path):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    data = await self.gateway.get(path)
+                if data is not None:
+                    self.n_bytes += len(data)
+                return data
+            except (FetchError, OSError, asyncio.TimeoutError) + _client_errors() as e:
+                if attempt == self.retries:
+                    raise FetchError("{}: {}".format(path, e)) from e
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+    async def get_json(self, path, required=True):
+        data = await self.get(path)
+        if data is None:
+            if required:
+                raise FetchError("{} not found".format(path))
+            return None
+        return json.loads(data)
+
+    async def metadata(self, cid, variables):
+        """
+        :returns: consolidated zarr metadata of the variables and their coordinates
+        """
+        consolidated = await self.get_json(cid + "/.zmetadata", required=False)
+        if consolidated is not None:
+            available = consolidated["metadata"]
+
+            async def get_meta(key):
+                return available.get(key)
+        else:
+            async def get_meta(key):
+                return await self.get_json(cid + "/" + key, required=False)
+
+        metadata = {".zgroup": await get_meta(".zgroup") or {"zarr_format": 2},
+                    ".zattrs": await get_meta(".zattrs") or {}}
+        pending = list(variables)
+        while pending:
+            names = [v for v in pending if v + "/.zarray" not in metadata]
+            found = await asyncio.gather(*[get_meta(v + "/.zarray") for v in names],
+                                         *[get_meta(v + "/.zattrs") for v in names])
+            pending = []
+            for name, zarray, zattrs in zip(names, found[:len(names)], found[len(names):]):
+                if zarray is None:
+                    raise FetchError("variable {} not found in {}".format(name, cid))
+                metadata[name + "/.zarray"] = zarray
+                metadata[name + "/.zattrs"] = zattrs or {}
+                # fetch the coordinates along the dimensions and those listed by the variable as well
+                zattrs = zattrs or {}
+                for coord in zattrs.get("_ARRAY_DIMENSIONS", []) + str(zattrs.get("coordinates", "")).split():
+                    if coord + "/.zarray" not in metadata and coord not in pending and coord not in names:
+                        if await get_meta(coord + "/.zarray") is not None:
+                            pending.append(coord)
+        return metadata
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def fetch_chunk(self, cid, key, target):
+        path = cid + "/" + key
+        data = await self.get(path)
+        if data is None:
+            # chunks which don't exist in the source are read as fill value
+            directory, name = path.rsplit("/", 1)
+            names = await self.gateway.listing(directory)
+            if names is None or name in names:
+                raise FetchError("{} not found".format(path))
+            return
+        self._write(os.path.join(target, *key.split("/")), data)
+
+    async def fetch_store(self, cid, variables, store_dir=None):
+        """
+        copies the given variables of the zarr store cid into the local store
+
+        :param store_dir: directory of the local stores configured for the source, see __init__
+        :returns: path of the local copy
+        """
+        store_dir = self.store_dir or store_dir or default_store_dir()
+        path = local_store(cid, store_dir)
+        if path is not None:
+            return path
+
+        target = os.path.join(store_dir, cid)
+        metadata = await self.metadata(cid, variables)
+        names = [key[:-len("/.zarray")] for key in metadata if key.endswith("/.zarray")]
+        await asyncio.gather(*[self.fetch_chunk(cid, name + "/" + chunk, target)
+                               for name in names
+                               for chunk in chunk_keys(metadata[name + "/.zarray"])])
+
+        for key, value in metadata.items():
+            self._write(os.path.join(target, *key.split("/")), json.dumps(value).encode("utf-8"))
+        self._write(os.path.join(target, ".zmetadata"),
+                    json.dumps({"zarr_consolidated_format": 1, "metadata": metadata}).encode("utf-8"))
+        return target
+
+    async def prefetch(self, flights):
+        """
+        :param flights: list of (platform, flight_id)
+        :returns: list of local paths, None for flights without IPFS source or exceptions
+        """
+        async def fetch(platform, flight):
+            source = ipfs_source(platform, flight)
+            if source is None:
+                return None
+            return await self.fetch_store(*source)
+
+        try:
+            return await asyncio.gather(*[fetch(*f) for f in flights], return_exceptions=True)
+        finally:
+            await self.gateway.close()
+
+
+def _client_errors():
+    try:
+        import aiohttp
+    except ImportError:
+        return ()
+    return (aiohttp.ClientError,)
+
+
+def prefetch(flights, gateway=DEFAULT_GATEWAY, store_dir=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+             retries=DEFAULT_RETRIES):
+    """
+    fetches the navdata sources of many flights concurrently into the local store
+
+    :param flights: list of (platform, flight_id)
+    :param gateway: URL of an IPFS HTTP gateway or a directory with one subdirectory per CID
+    :returns: list of local paths, None for flights without IPFS source or exceptions
+    """
+    async def run():
+        prefetcher = Prefetcher(open_gateway(gateway, max_connections), store_dir, max_connections, retries)
+        return await prefetcher.prefetch(flights)
+    return asyncio.run(run())
+
+
+def write_example_store(path, n=1000, chunk_size=256):
+    """
+    writes a small zarr v2 store laid out like the BAHAMAS stores (dimension tid,
+    time in TIME, uncompressed chunks), such that it can be written without zarr
+    """
+    import numpy as np
+    seconds = np.arange(n, dtype="<i8")
+    arrays = {"TIME": (seconds, {"units": "seconds since 2024-08-01 12:00:00", "calendar": "proleptic_gregorian"})}
+    for k, name in enumerate(BAHAMAS_VARIABLES[1:]):
+        arrays[name] = (np.sin(seconds / 100. + k).astype("<f8"), {"coordinates": "TIME"})
+    arrays["IRS_GS"] = (np.full(n, 200., dtype="<f8"), {"coordinates": "TIME"})  # not fetched
+
+    metadata = {".zgroup": {"zarr_format": 2}, ".zattrs": {"title": "BAHAMAS example"}}
+    for name, (values, attrs) in arrays.items():
+        metadata[name + "/.zarray"] = {"zarr_format": 2, "shape": [n], "chunks": [chunk_size],
+                                       "dtype": values.dtype.str, "compressor": None, "filters": None,
+                                       "fill_value": "NaN" if values.dtype.kind == "f" else None,
+                                       "order": "C"}
+        metadata[name + "/.zattrs"] = dict(attrs, _ARRAY_DIMENSIONS=["tid"])
+        os.makedirs(os.path.join(path, name))
+        for i, start in enumerate(range(0, n, chunk_size)):
+            chunk = np.zeros(chunk_size, dtype=values.dtype)
+            chunk[:min(chunk_size, n - start)] = values[start:start + chunk_size]
+            with open(os.path.join(path, name, str(i)), "wb") as f:
+                f.write(chunk.tobytes())
+    for key, value in metadata.items():
+        with open(os.path.join(path, *key.split("/")), "w") as f:
+            json.dump(value, f)
+    with open(os.path.join(path, ".zmetadata"), "w") as f:
+        json.dump({"zarr_consolidated_format": 1, "metadata": metadata}, f)
+    return arrays
+
+
+class _FlakyGateway(DirectoryGateway):
+    """
+    directory gateway which fails to find the given paths, like an IPFS gateway timing out with 404
+    """
+    def __init__(self, root, failing):
+        super().__init__(root)
+        self.failing = set(failing)
+
+    async def get(self, path):
+        if path in self.failing:
+            return None
+        return await super().get(path)
+
+
+def check_prefetch(workdir):
+    """
+    prefetches an example store from a directory gateway and opens it through the ipfs_bahamas backend
+
+    Opening is skipped if the dependencies of the backend are not installed.
+
+    :param workdir: empty directory for the gateway and the local store
+    :returns: (list of problems, list of skipped steps), no problems if the prefetched store can be used
+    """
+    import numpy as np
+    from navdata import BahamasIPFSBackend
+
+    cid = "QmExampleBahamasStore"
+    flight = "HALO-20240801a"
+    gateway_dir = os.path.join(workdir, "gateway")
+    arrays = write_example_store(os.path.join(gateway_dir, cid))
+    # a chunk missing in the source is read as fill value
+    os.remove(os.path.join(gateway_dir, cid, "IRS_HDG", "1"))
+    backend = BahamasIPFSBackend("HALO", {"flights": {flight: cid}, "store_dir": "store"}, workdir)
+    problems = []
+
+    async def run(gateway):
+        return await Prefetcher(gateway, retries=0).fetch_store(*backend.ipfs_source(flight))
+
+    # a chunk which exists in the source but can't be fetched leaves the copy incomplete
+    try:
+        asyncio.run(run(_FlakyGateway(gateway_dir, [cid + "/IRS_LAT/2"])))
+        problems.append("prefetch succeeded although a chunk could not be fetched")
+    except FetchError:
+        pass
+    if local_store(cid, backend.store_dir()) is not None:
+        problems.append("incomplete prefetched store is used by the backend")
+
+    path = asyncio.run(run(DirectoryGateway(gateway_dir)))
+    if path != local_store(cid, backend.store_dir()):
+        problems.append("prefetched store {} is not found by the backend".format(path))
+    missing = [name for name in BAHAMAS_VARIABLES if not os.path.exists(os.path.join(path, name, ".zarray"))]
+    if missing:
+        problems.append("prefetched store lacks {}".format(", ".join(missing)))
+    if os.path.exists(os.path.join(path, "IRS_GS")):
+        problems.append("prefetched store contains variables which are not used")
+    if problems:
+        return problems, []
+
+    try:
+        import zarr
+        import orcestra.postprocess.level0
+    except ImportError as e:
+        return problems, ["opening the store through the backend, {} is not installed".format(e.name)]
+    try:
+        navdata = backend.get(flight).load()
+    except Exception as e:
+        return ["prefetched store can't be opened through the backend: {}: {}".format(type(e).__name__, e)], []
+    expected_time = np.datetime64("2024-08-01T12:00:00", "ns") + arrays["TIME"][0].astype("timedelta64[s]")
+    if not np.array_equal(navdata.time.values, expected_time):
+        problems.append("time of the prefetched store differs from the source")
+    if not np.array_equal(navdata.lat.values, arrays["IRS_LAT"][0]):
+        problems.append("lat of the prefetched store differs from the source")
+    heading = arrays["IRS_HDG"][0].copy()
+    heading[256:512] = np.nan  # fill value of the missing chunk
+    if not np.array_equal(navdata.heading.values, heading, equal_nan=True):
+        problems.append("heading of the prefetched store differs from the source")
+    return problems, []
+
+
+def flights_of(segment_files, cache=True, cache_dir=None):
+    """
+    :param cache: use the parse cache
+    :param cache_dir: directory of the navdata cache (--cache-dir), see yamlload.load_cached
+    :returns: list of (platform, flight_id) of the given segment files
+    """
+    from yamlload import load_yaml
+    flights = []
+    for filename in segment_files:
+        flight = load_yaml(filename, cache=cache, cache_dir=cache_dir)
+        flights.append((flight["platform"], flight["flight_id"]))
+    return flights
+
+
+def _main():
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="prefetch navdata of many flights into the local store")
+    parser.add_argument("infiles", nargs="*", help="segment files of the flights to prefetch")
+    parser.add_argument("-g", "--gateway", default=DEFAULT_GATEWAY,
+                        help="IPFS HTTP gateway or local directory with one subdirectory per CID")
+    parser.add_argument("-c", "--connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="maximum number of concurrent requests")
+    parser.add_argument("-r", "--retries", type=int, default=DEFAULT_RETRIES, help="retries per request")
+    parser.add_argument("--check", action="store_true",
+                        help="instead of prefetching, check offline that a prefetched example store can be opened")
+    args = parser.parse_args()
+
+    if args.check:
+        import tempfile
+        with tempfile.TemporaryDirectory() as workdir:
+            problems, skipped = check_prefetch(workdir)
+        for problem in problems:
+            print("ERROR: " + problem, file=sys.stderr)
+        for step in skipped:
+            print("skipped " + step, file=sys.stderr)
+        print("prefetch check {}".format("failed" if problems else "passed"), file=sys.stderr)
+        return 1 if problems else 0
+    if not args.infiles:
+        parser.error("expected segment files of the flights to prefetch")
+
+    flights = flights_of(args.infiles)
+    t0 = time.perf_counter()
+    results = prefetch(flights, args.gateway, max_connections=args.connections, retries=args.retries)
+    n_failed = 0
+    for (platform, flight), result in zip(flights, results):
+        if isinstance(result, Exception):
+            n_failed += 1
+            print("{} {}: failed: {}".format(platform, flight, result), file=sys.stderr)
+        elif result is None:
+            print("{} {}: no IPFS source".format(platform, flight), file=sys.stderr)
+        else:
+            print("{} {}: {}".format(platform, flight, result), file=sys.stderr)
+    print("prefetched {} flights in {:.1f} s".format(len(flights) - n_failed, time.perf_counter() - t0),
+          file=sys.stderr)
+    return 1 if n_failed else 0
+
+
+__all__ = ["prefetch", "local_store", "Prefetcher", "open_gateway", "check_prefetch", "BAHAMAS_VARIABLES"]
+
+if __name__ == "__main__":
+    exit(_main())
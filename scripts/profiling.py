@@ -0,0 +1,205 @@
+# timing and memory instrumentation for the scripts
+#
+# a Profiler records wall time, CPU time and peak memory of nested stages.
+# By default, peak memory is the growth of the peak RSS of the process, which
+# is cheap but only shows stages which raise the high-water mark. Tracing
+# Python allocations with tracemalloc gives exact per stage peaks, but slows
+# down allocation heavy code (e.g. matplotlib) a lot.
+#
+# records can be printed as a summary table, written as Chrome trace (load in
+# chrome://tracing or https://ui.perfetto.dev) and optionally a single stage
+# can be run under cProfile.
+
+import os
+import sys
+import time
+import json
+from contextlib import contextmanager
+
+
+def peak_rss(children=False):
+    """
+    :param children: include worker processes which have finished, e.g. after shutting down an executor
+    :returns: peak resident set size of this process (or of the largest finished child) in bytes
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    def __init__(self, enabled=True, trace_memory=False, cprofile_stage=None, cprofile_output=None):
+        """
+        :param enabled: if False, stages are not measured at all
+        :param trace_memory: use tracemalloc to measure peak memory
+        :param cprofile_stage: name of a stage to run under cProfile
+        :param cprofile_output: file for the cProfile statistics, defaults to <stage>.prof
+        """
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records = []
+        self._open = []
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_output = cprofile_output or "{}.prof".format(cprofile_stage)
+        self._cprofile = None
+        if enabled and trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def _memory(self):
+        """
+        :returns: (current, peak) memory
+        """
+        if self.trace_memory:
+            import tracemalloc
+            return tracemalloc.get_traced_memory()
+        peak = peak_rss()
+        return peak, peak
+
+    def _update_peaks(self):
+        _, peak = self._memory()
+        for entry in self._open:
+            entry["peak"] = max(entry["peak"], peak)
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name, category="stage", **args):
+        """
+        measures the enclosed code as a stage
+
+        :param category: kind of stage, e.g. "segment" or "plot"
+        :param args: additional information stored with the record, e.g. segment_id
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self._update_peaks()
+        entry = {"peak": self._memory()[0]}
+        self._open.append(entry)
+        base_memory = entry["peak"]
+
+        profile = None
+        if name == self.cprofile_stage:
+            import cProfile
+            if self._cprofile is None:
+                self._cprofile = cProfile.Profile()
+            profile = self._cprofile
+            profile.enable()
+
+        start = time.time()
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+            if profile is not None:
+                profile.disable()
+            self._update_peaks()
+            self._open.pop()
+            self.records.append({
+                "name": name,
+                "category": category,
+                "start": start,
+                "wall": wall,
+                "cpu": cpu,
+                "peak_memory": entry["peak"] - base_memory,
+                "pid": os.getpid(),
+                "args": args,
+            })
+
+    def add(self, records):
+        """
+        adds records measured elsewhere, e.g. in worker processes
+        """
+        self.records += records
+
+    def summary(self):
+        """
+        :returns: list of per stage name aggregates, in order of first appearance
+        """
+        rows = {}
+        for r in self.records:
+            row = rows.setdefault((r["category"], r["name"]), {
+                "category": r["category"], "name": r["name"],
+                "count": 0, "wall": 0., "cpu": 0., "peak_memory": 0,
+            })
+            row["count"] += 1
+            row["wall"] += r["wall"]
+            row["cpu"] += r["cpu"]
+            row["peak_memory"] = max(row["peak_memory"], r["peak_memory"])
+        return list(rows.values())
+
+    def summary_table(self):
+        lines = ["{:<10} {:<32} {:>6} {:>10} {:>10} {:>12}".format(
+                 "category", "name", "count", "wall [s]", "cpu [s]", "peak [MiB]")]
+        for row in self.summary():
+            lines.append("{:<10} {:<32} {:>6} {:>10.3f} {:>10.3f} {:>12.1f}".format(
+                         row["category"], row["name"][:32], row["count"],
+                         row["wall"], row["cpu"], row["peak_memory"] / 2**20))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        return {
+            "traceEvents": [{
+                "name": r["name"],
+                "cat": r["category"],
+                "ph": "X",
+                "ts": r["start"] * 1e6,
+                "dur": r["wall"] * 1e6,
+                "pid": r["pid"],
+                "tid": 0,
+                "args": {**r["args"], "cpu": r["cpu"], "peak_memory": r["peak_memory"]},
+            } for r in self.records],
+            "displayTimeUnit": "ms",
+        }
+
+    def finish(self, output=None):
+        """
+        prints the summary and writes trace and cProfile output
+        """
+        if not self.enabled:
+            return
+        print(self.summary_table(), file=sys.stderr)
+        if output is not None:
+            with open(output, "w") as f:
+                json.dump(self.chrome_trace(), f)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self.cprofile_output)
+            print("cProfile statistics of stage {} written to {}".format(
+                  self.cprofile_stage, self.cprofile_output), file=sys.stderr)
+
+
+def call_profiled(fn, trace_memory, *args, **kwargs):
+    """
+    calls fn(*args, profiler=..., **kwargs) with a fresh profiler, e.g. in a worker process
+
+    :returns: (result, records)
+    """
+    profiler = Profiler(trace_memory=trace_memory)
+    result = fn(*args, profiler=profiler, **kwargs)
+    return result, profiler.records
+
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="record wall time, CPU time and peak memory per stage")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="trace Python allocations for exact peak memory per stage (slow)")
+    parser.add_argument("--profile-output", help="write profile records as Chrome trace JSON")
+    parser.add_argument("--cprofile", metavar="STAGE", help="run the given stage under cProfile")
+
+
+def profiler_from_args(args):
+    return Profiler(enabled=args.profile or args.profile_memory or args.cprofile is not None,
+                    trace_memory=args.profile_memory,
+                    cprofile_stage=args.cprofile)
+
+__all__ = ["peak_rss", "Profiler", "call_profiled", "add_profile_arguments", "profiler_from_args"]
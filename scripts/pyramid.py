@@ -0,0 +1,103 @@
+
+# bin sizes (in raw samples) of the decimated levels, finest first
+DEFAULT_BIN_SIZES = [32, 128, 512, 2048, 8192]
+
+
+def minmax_indices(data, bin_size):
+    """
+    :param data: 2d array of shape (variables, time)
+    :param bin_size: number of samples per bin
+    :returns: sorted indices of the minimum and maximum of every variable in every bin
+    """
+    import numpy as np
+    n = data.shape[1]
+    n_full = n // bin_size * bin_size
+    indices = []
+    if n_full > 0:
+        binned = data[:, :n_full].reshape(data.shape[0], -1, bin_size)
+        offsets = np.arange(0, n_full, bin_size)
+        indices.append((np.nanargmin(binned, axis=2) + offsets).ravel())
+        indices.append((np.nanargmax(binned, axis=2) + offsets).ravel())
+    if n_full < n:
+        tail = data[:, n_full:]
+        indices.append(np.nanargmin(tail, axis=1) + n_full)
+        indices.append(np.nanargmax(tail, axis=1) + n_full)
+    if len(indices) == 0:
+        return np.zeros(0, dtype="int64")
+    return np.unique(np.concatenate(indices))
+
+
+class NavdataPyramid:
+    """
+    multi-resolution versions of navdata for plotting
+
+    Every level is a subset of the original samples which contains the
+    minimum and maximum of every variable within each bin, so short spikes
+    (e.g. in roll) remain visible on coarse levels.
+    """
+    def __init__(self, navdata, bin_sizes=DEFAULT_BIN_SIZES, level_indices=None):
+        """
+        :param navdata: loaded navdata
+        :param level_indices: precomputed indices per level, see NavdataPyramid.level_indices
+        """
+        import numpy as np
+        if level_indices is None:
+            variables = [v for v in navdata.data_vars.values() if v.dims == ("time",)]
+            data = np.stack([v.values.astype("float64") for v in variables]) \
+                   if len(variables) > 0 else np.zeros((0, len(navdata.time)))
+            # all-NaN bins would break nanargmin/nanargmax, variables without any value are filled with 0
+            valid = ~np.isnan(data)
+            n_valid = np.count_nonzero(valid, axis=1)[:, None]
+            fill = np.where(valid, data, 0.).sum(axis=1, keepdims=True) / np.maximum(n_valid, 1)
+            data = np.where(valid, data, fill)
+            level_indices = [minmax_indices(data, bin_size)
+                             for bin_size in bin_sizes
+                             if bin_size < len(navdata.time)]
+        self.level_indices = level_indices
+        self.levels = [navdata] + [navdata.isel(time=i) for i in level_indices]
+
+    def select(self, start, end, min_points):
+        """
+        :returns: the coarsest level with at least min_points samples within [start, end]
+        """
+        import numpy as np
+        start = np.datetime64(start)
+        end = np.datetime64(end)
+        for level in reversed(self.levels[1:]):
+            times = level.time.values
+            count = np.searchsorted(times, end, side="right") - np.searchsorted(times, start, side="left")
+            if count >= min_points:
+                return level
+        return self.levels[0]
+
+
+def get_pyramid(navdata, cache=None):
+    """
+    builds the pyramid of navdata or retrieves it from cache
+
+    Only navdata which has been read from the navdata cache has a content
+    addressed source which can be used as a key. Windows of a flight (see
+    navdata.load_windows) share the source with the full flight, hence a
+    hash of the time axis is part of the key as well.
+
+    :param cache: optional PickleCache for the level indices
+    """
+    import numpy as np
+    import os
+    import hashlib
+    from navcache import cache_key
+
+    source = navdata.encoding.get("source")
+    if cache is None or source is None:
+        return NavdataPyramid(navdata)
+
+    time_hash = hashlib.sha256(np.ascontiguousarray(navdata.time.values).tobytes()).hexdigest()
+    key = cache_key("pyramid", os.path.basename(source), time_hash, DEFAULT_BIN_SIZES)
+    level_indices = cache.get(key)
+    if level_indices is None:
+        pyramid = NavdataPyramid(navdata)
+        cache.put(key, pyramid.level_indices)
+        return pyramid
+    return NavdataPyramid(navdata, level_indices=level_indices)
+
+__all__ = ["NavdataPyramid", "get_pyramid"]
@@ -1,17 +1,31 @@
 import os
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-import yaml
-import xarray as xr
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+import re
+import sys
+import json
+import hashlib
 from io import BytesIO
 from base64 import b64encode
-
-from navdata import get_navdata
-from checkers import FlightChecker, kinds_is_circle
-
-border_time = np.timedelta64(3, "m")
+from functools import partial
+
+from navdata import get_navdata, load_windows
+from navcache import add_cache_arguments, cache_from_args, default_cache_dir, \
+                     PickleCache, update_dataset_hash, file_fingerprint
+from checkers import check_flight_batch, split_warnings, kinds_is_circle
+from sondeindex import SondeIndex, load_sonde_index
+from sondetracks import flight_sonde_tracks, load_sonde_tracks
+from segmentstats import get_segment_statistics, statistics_cache
+from yamlload import load_yaml
+from pyramid import get_pyramid
+from profiling import Profiler, call_profiled, add_profile_arguments, profiler_from_args, peak_rss
+import pyramid
+
+# navdata shown before and after a segment
+BORDER_MINUTES = 3
+
+# minimum number of samples within a plotted time range, about two per
+# pixel of an 8 inch wide figure. Plots use the coarsest level of the
+# navdata pyramid which still provides this many samples.
+min_plot_points = 1600
 
 color_before = "C2"
 color_at = "C0"
@@ -24,18 +38,98 @@ sonde_styles = {
     "UGLY": {"color": "orange", "marker": "d"},
 }
 
-env = Environment(
-    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')),
-    autoescape=select_autoescape(['html', 'xml'])
-)
+_env = None
 
-def fig2data_url(fig):
+
+def template_env():
+    """
+    :returns: jinja2 Environment of the report templates, created on first use
+    """
+    global _env
+    if _env is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        _env = Environment(
+            loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')),
+            autoescape=select_autoescape(['html', 'xml'])
+        )
+    return _env
+
+def fig2png(fig):
     io = BytesIO()
     fig.savefig(io, format="PNG", bbox_inches="tight")
-    b64 = b64encode(io.getvalue())
+    return io.getvalue()
+
+def fig2data_url(fig):
+    b64 = b64encode(fig2png(fig))
     url = "data:{};base64,{}".format("image/png", b64.decode("ascii"))
     return url
 
+# options passed to Pillow when writing image files
+IMAGE_FORMATS = {
+    "png": {"optimize": True},
+    "webp": {"lossless": True},
+}
+
+class ImageWriter:
+    """
+    encodes figures as image files named by the hash of their content
+
+    Can be used instead of fig2data_url, the result is the path of the image
+    relative to base_dir. Identical figures end up in the same file, so
+    images are shared between regenerated reports and between flights.
+    """
+    def __init__(self, image_dir, base_dir, image_format="png", dpi=None):
+        """
+        :param image_dir: directory to write images to
+        :param base_dir: directory of the report referencing the images
+        :param image_format: one of IMAGE_FORMATS
+        :param dpi: resolution of the images, defaults to the resolution of the figure
+        """
+        self.image_dir = image_dir
+        self.base_dir = base_dir
+        self.image_format = image_format
+        self.dpi = dpi
+
+    def __repr__(self):
+        return "ImageWriter({!r}, {!r}, {!r}, {!r})".format(
+            os.path.relpath(self.image_dir, self.base_dir), ".", self.image_format, self.dpi)
+
+    def __call__(self, fig):
+        io = BytesIO()
+        fig.savefig(io, format=self.image_format, bbox_inches="tight", dpi=self.dpi or "figure",
+                    pil_kwargs=IMAGE_FORMATS[self.image_format])
+        data = io.getvalue()
+        path = os.path.join(self.image_dir, "{}.{}".format(hashlib.sha256(data).hexdigest()[:32],
+                                                           self.image_format))
+        if not os.path.exists(path):
+            os.makedirs(self.image_dir, exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return os.path.relpath(path, self.base_dir).replace(os.sep, "/")
+
+    def exists(self, url):
+        return os.path.exists(os.path.join(self.base_dir, url))
+
+def prune_images(image_dir, html_files):
+    """
+    removes image files written by ImageWriter which none of html_files refers to
+
+    :returns: number of removed files
+    """
+    image_name = re.compile(r"[0-9a-f]{{32}}\.(?:{})".format("|".join(IMAGE_FORMATS)))
+    referenced = set()
+    for filename in html_files:
+        with open(filename) as f:
+            referenced.update(image_name.findall(f.read()))
+    removed = 0
+    for name in os.listdir(image_dir) if os.path.isdir(image_dir) else []:
+        if image_name.fullmatch(name) and name not in referenced:
+            os.remove(os.path.join(image_dir, name))
+            removed += 1
+    return removed
+
 def start_end_lims(navdata):
     lat_min = min(*navdata.lat.data[[0,-1]])
     lat_max = max(*navdata.lat.data[[0,-1]])
@@ -52,7 +146,16 @@ def plot_sondes(ax, sonde_tracks_by_flag, **kwargs):
             t = sonde_tracks_by_flag[flag]
             ax.scatter(t.lon, t.lat, **kwargs, **style)
 
+def full_resolution(plot):
+    """
+    marks plots which need all samples, e.g. because they zoom in on a few seconds
+    """
+    plot.full_resolution = True
+    return plot
+
 def default_segment_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
     fig = plt.figure(figsize=(8, 5), constrained_layout=True)
     spec = gridspec.GridSpec(ncols=3, nrows=4, figure=fig)
     overview_ax = fig.add_subplot(spec[:, :2])
@@ -87,7 +190,9 @@ def default_segment_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
 
     return fig
 
+@full_resolution
 def circle_detail_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
+    import matplotlib.pyplot as plt
     fig, zoom_ax = plt.subplots(1, figsize=(4,4), constrained_layout=True)
     zoom_ax.plot(seg.lon, seg.lat, "o-", color=color_at, zorder=10)
     zoom_ax.plot(seg_before.lon, seg_before.lat, "x-", color=color_before, alpha=.3, zorder=0)
@@ -110,7 +215,9 @@ def circle_detail_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
 
     return fig
 
+@full_resolution
 def straight_leg_detail_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
+    import matplotlib.pyplot as plt
     fig, (start_ax, end_ax) = plt.subplots(1, 2, figsize=(8,4), constrained_layout=True)
 
     start_lat, end_lat = seg.lat.data[[0, -1]]
@@ -132,15 +239,22 @@ def straight_leg_detail_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
 
     return fig
 
-def zoom_on(var, unit, tofs=np.timedelta64(30, "s")):
+def zoom_on(var, unit, tofs=30):
+    """
+    :param tofs: seconds shown around the start and the end of the segment
+    """
+    @full_resolution
     def zoom_plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
+        import numpy as np
+        import matplotlib.pyplot as plt
         fig, (start_ax, end_ax) = plt.subplots(1, 2, figsize=(8,3), constrained_layout=True)
 
-        tofs2 = tofs + np.timedelta64(1, "s")
+        shown = np.timedelta64(tofs, "s")
+        shown2 = shown + np.timedelta64(1, "s")
 
         for ax, t, name in [(start_ax, seg.time.data[0], "start"),
                             (end_ax, seg.time.data[-1], "end")]:
-            ts = slice(t - tofs2, t + tofs2)
+            ts = slice(t - shown2, t + shown2)
             s1 = seg[var].sel(time=ts)
             s0 = seg_before[var].sel(time=ts)
             s2 = seg_after[var].sel(time=ts)
@@ -154,13 +268,15 @@ def zoom_on(var, unit, tofs=np.timedelta64(30, "s")):
             ax.set_title("zoom on {}".format(name))
             ax.set_ylabel("{} [{}]".format(var, unit))
 
-            ax.set_xlim(t - tofs, t + tofs)
+            ax.set_xlim(t - shown, t + shown)
 
         return fig
+    zoom_plot.__name__ = "zoom_on_{}".format(var)
     return zoom_plot
 
 def timeline_of(var, unit):
     def plot(seg, sonde_tracks_by_flag, seg_before, seg_after):
+        import matplotlib.pyplot as plt
         fig, ax  = plt.subplots(1, 1, figsize=(8,3), constrained_layout=True)
 
         seg[var].plot(ax=ax, color=color_at, zorder=10)
@@ -170,13 +286,14 @@ def timeline_of(var, unit):
         ax.set_ylabel("{} [{}]".format(var, unit))
 
         return fig
+    plot.__name__ = "timeline_of_{}".format(var)
     return plot
 
 SPECIAL_PLOTS = {
     "circle": [circle_detail_plot, zoom_on("roll", "deg")],
-    "circling": [zoom_on("roll", "deg", tofs=np.timedelta64(3, "m")),
-                 zoom_on("pitch", "deg", tofs=np.timedelta64(3, "m")),
-                 zoom_on("alt", "m", tofs=np.timedelta64(3, "m"))],
+    "circling": [zoom_on("roll", "deg", tofs=180),
+                 zoom_on("pitch", "deg", tofs=180),
+                 zoom_on("alt", "m", tofs=180)],
     "straight_leg": [straight_leg_detail_plot, zoom_on("roll", "deg")],
     "radar_calibration_wiggle": [zoom_on("roll", "deg")],
     "radar_calibration_tilted": [zoom_on("roll", "deg")],
@@ -190,92 +307,488 @@ def plots_for_kinds(kinds):
             for kind in kinds
             for plot in SPECIAL_PLOTS.get(kind, [])]
 
+def render_plot(kinds, index, seg, sonde_tracks_by_flag, seg_before, seg_after, segment_id=None, profiler=None,
+                encode=fig2data_url):
+    """
+    renders the index-th plot of plots_for_kinds(kinds)
+
+    Plots are referenced by index, as the plot functions themselves are
+    closures which can't be sent to worker processes.
+
+    :param segment_id: stored with the profile records, as plots may be rendered outside of the segment stage
+    :param profiler: optional Profiler to record plotting and encoding times
+    :param encode: function turning the figure into the result, e.g. fig2png
+    :returns: (encoded figure, None) or (None, warning) if the plot could not be created
+    """
+    import matplotlib.pyplot as plt
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    plot = plots_for_kinds(kinds)[index]
+    try:
+        with profiler.stage(plot.__name__, "plot", segment_id=segment_id):
+            fig = plot(seg, sonde_tracks_by_flag, seg_before, seg_after)
+        with profiler.stage(getattr(encode, "__name__", type(encode).__name__), "encode", plot=plot.__name__,
+                            segment_id=segment_id):
+            return encode(fig), None
+    except Exception as e:
+        return None, "plot could not be created: {}".format(e)
+    finally:
+        plt.close("all")
+
+def render_overview_plot(navdata, encode=fig2data_url):
+    """
+    :returns: (encoded figure, None) like render_plot
+    """
+    import matplotlib.pyplot as plt
+    try:
+        fig, ax = plt.subplots()
+        ax.plot(navdata.lon, navdata.lat)
+        return encode(fig), None
+    finally:
+        plt.close("all")
+
+def _render_plot_unprofiled(*plot_args, **kwargs):
+    return render_plot(*plot_args, **kwargs), []
+
+def plot_fingerprint(code_version, seg, kinds, seg_navdata, sonde_tracks_by_flag, seg_before, seg_after):
+    """
+    :param code_version: fingerprint of the plotting code
+    :param seg: segment as read from the YAML file
+    :returns: key identifying all inputs to the plots of a segment
+    """
+    h = hashlib.sha256()
+    h.update(code_version.encode("utf-8"))
+    h.update(json.dumps([seg, kinds, "{} minutes".format(BORDER_MINUTES)], sort_keys=True, default=str).encode("utf-8"))
+    for ds in [seg_navdata, seg_before, seg_after]:
+        update_dataset_hash(h, ds)
+    for flag, tracks in sorted(sonde_tracks_by_flag.items()):
+        h.update(flag.encode("utf-8"))
+        update_dataset_hash(h, tracks)
+    return h.hexdigest()
+
+def _init_plot_worker():
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+
+
+def load_report_navdata(navdata, flightdata, sonde_index, lazy=False):
+    """
+    loads the navdata needed for the report of a flight
+
+    :param lazy: only load navdata around segments and sonde launches
+    :returns: (navdata, overview_navdata), overview_navdata is None if not lazy
+    """
+    import numpy as np
+    border_time = np.timedelta64(BORDER_MINUTES, "m")
+    if not lazy:
+        return navdata.load(), None
+
+    # the overview only needs a thinned out track, everything else only
+    # looks at segments (with borders) and sonde launches
+    sondes_by_id = sonde_index.sondes_by_id
+    step = max(1, len(navdata.time) // 20000)
+    overview_navdata = navdata[["lat", "lon"]].isel(time=slice(None, None, step)).load()
+    windows = []
+    for seg in flightdata["segments"]:
+        t_start = np.datetime64(seg["start"])
+        t_end = np.datetime64(seg["end"])
+        windows.append((t_start - border_time, t_end + border_time))
+        for sondes in seg.get("dropsondes", {}).values():
+            windows += [(np.datetime64(sondes_by_id[s]["launch_time"]),) * 2
+                        for s in sondes
+                        if s in sondes_by_id]
+    return load_windows(navdata, windows), overview_navdata
+
+
+def _plot_in_process(*plot_args, segment_id=None, profiler=None, encode=fig2data_url):
+    return lambda: (render_plot(*plot_args, segment_id=segment_id, profiler=profiler, encode=encode), [])
+
+
+def render_report(flightdata, navdata, sonde_index, global_warnings=(), submit_plot=None,
+                  plot_cache=None, code_version=None, pyramid_cache=None, navdata_pyramid=None,
+                  overview_navdata=None, defer_plot=None, encode=fig2data_url, overview_encode=None,
+                  sonde_tracks=None, statistics_cache=None, profiler=None):
+    """
+    runs the checks, renders the plots and the HTML report of a flight
+
+    flightdata is filled with the information shown in the report.
+
+    :param navdata: loaded navdata of the flight, see load_report_navdata
+    :param global_warnings: additional flight warnings
+    :param submit_plot: function taking the arguments of render_plot (including
+                        segment_id and encode) and returning either a (result, records) tuple
+                        or a callable returning it, renders in this process by default
+    :param plot_cache: optional cache of plots, requires code_version
+    :param code_version: fingerprint of the plotting code
+    :param pyramid_cache: optional cache for the navdata pyramid
+    :param navdata_pyramid: already computed navdata pyramid
+    :param overview_navdata: track for the overview plot, defaults to a coarse pyramid level
+    :param defer_plot: instead of rendering plots, call defer_plot(fingerprint, index, render)
+                       and use the returned URL, render(encode=...) renders the plot
+                       later. Requires code_version.
+    :param encode: encoding of the plots, fig2data_url or an ImageWriter
+    :param overview_encode: encoding of the overview plot, defaults to encode
+    :param sonde_tracks: launch positions of the attached sondes (e.g. written by attach_sondes.py --tracks),
+                         looked up in navdata by default or if sondes are missing in the table
+    :param statistics_cache: optional cache for the segment statistics, shared with verify.py
+    :returns: HTML
+    """
+    import numpy as np
+    border_time = np.timedelta64(BORDER_MINUTES, "m")
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    if submit_plot is None:
+        submit_plot = partial(_plot_in_process, profiler=profiler)
+    if overview_encode is None:
+        overview_encode = encode
+    # cached image files may have been deleted in the meantime
+    exists = getattr(encode, "exists", lambda url: True)
+
+    platform_sondes = sonde_index[flightdata.get("platform", "")]
+
+    if navdata_pyramid is None:
+        with profiler.stage("pyramid"):
+            navdata_pyramid = get_pyramid(navdata, pyramid_cache)
+    if overview_navdata is None:
+        if len(navdata.time) > 0:
+            overview_navdata = navdata_pyramid.select(navdata.time.values[0], navdata.time.values[-1],
+                                                      min_plot_points)
+        else:
+            overview_navdata = navdata
+
+    if plot_cache is not None or defer_plot is not None:
+        h = hashlib.sha256(code_version.encode("utf-8"))
+        update_dataset_hash(h, overview_navdata[["lat", "lon"]])
+        overview_fingerprint = h.hexdigest()
+
+    if defer_plot is not None:
+        im = defer_plot(overview_fingerprint, 0, partial(render_overview_plot, overview_navdata))
+    elif plot_cache is not None:
+        im = plot_cache.get(overview_fingerprint)
+        if im is not None and not getattr(overview_encode, "exists", exists)(im):
+            im = None
+    else:
+        im = None
+
+    if im is None:
+        with profiler.stage("overview_plot", "plot"):
+            im, _ = render_overview_plot(overview_navdata, overview_encode)
+        if plot_cache is not None:
+            plot_cache.put(overview_fingerprint, im)
+    flightdata["plot_data"] = im
+
+    with profiler.stage("checks"):
+        flight_warnings, segment_warnings = split_warnings(check_flight_batch(flightdata, navdata, sonde_index),
+                                                           flightdata)
+    global_warnings = flight_warnings + list(global_warnings)
+
+    if sonde_tracks is None or not all(sonde_tracks.covers(seg.get("dropsondes") or {})
+                                       for seg in flightdata["segments"]):
+        with profiler.stage("sonde_tracks"):
+            sonde_tracks = flight_sonde_tracks(flightdata, navdata, sonde_index)
+    with profiler.stage("statistics"):
+        statistics = get_segment_statistics(flightdata, navdata, sonde_index, statistics_cache)
+    time_to_first_sonde = statistics.time_to_first_sonde.values
+    heading_difference = statistics.heading_difference.values
+
+    pending_plots = []
+    for k, (seg, (_, warnings)) in enumerate(zip(flightdata["segments"], segment_warnings)):
+        with profiler.stage("segment", "segment", segment_id=seg.get("segment_id")):
+            # malformed fields are reported as warnings, but are not shown
+            if "kinds" in seg and not isinstance(seg["kinds"], list):
+                del seg["kinds"]
+            if "irregularities" in seg and not (isinstance(seg["irregularities"], list)
+                                                and all(isinstance(i, str) for i in seg["irregularities"])):
+                del seg["irregularities"]
+            seg_yaml = dict(seg)
+            t_start = np.datetime64(seg["start"])
+            t_end = np.datetime64(seg["end"])
+            seg_navdata = navdata.sel(time=slice(t_start, t_end))
+            seg_before = navdata.sel(time=slice(t_start - border_time, t_start))
+            seg_after = navdata.sel(time=slice(t_end, t_end + border_time))
+
+            coarse_navdata = navdata_pyramid.select(t_start - border_time, t_end + border_time, min_plot_points)
+            coarse_slices = (coarse_navdata.sel(time=slice(t_start, t_end)),
+                             coarse_navdata.sel(time=slice(t_start - border_time, t_start)),
+                             coarse_navdata.sel(time=slice(t_end, t_end + border_time)))
+
+            seg["sondes_by_flag"] = platform_sondes.sondes_by_flag(seg["start"], seg["end"])
+            sonde_tracks_by_flag = sonde_tracks.by_flag(seg.get("dropsondes") or {})
+
+            kinds = seg.get("kinds", [])
+            fingerprint = None
+            plot_results = None
+            if plot_cache is not None or defer_plot is not None:
+                fingerprint = plot_fingerprint(code_version, seg_yaml, kinds,
+                                               seg_navdata, sonde_tracks_by_flag, seg_before, seg_after)
+            if plot_cache is not None and defer_plot is None:
+                plot_results = plot_cache.get(fingerprint)
+                if plot_results is not None and not all(exists(url) for url, _ in plot_results if url is not None):
+                    plot_results = None
+            if plot_results is None:
+                plot_results = []
+                for i, plot in enumerate(plots_for_kinds(kinds)):
+                    if getattr(plot, "full_resolution", False):
+                        plot_seg, plot_before, plot_after = seg_navdata, seg_before, seg_after
+                    else:
+                        plot_seg, plot_before, plot_after = coarse_slices
+                    plot_args = (kinds, i, plot_seg, sonde_tracks_by_flag, plot_before, plot_after)
+                    if defer_plot is not None:
+                        render = partial(render_plot, *plot_args, segment_id=seg.get("segment_id"))
+                        plot_results.append((defer_plot(fingerprint, i, render), None))
+                    else:
+                        plot_results.append(submit_plot(*plot_args, segment_id=seg.get("segment_id"), encode=encode))
+                if defer_plot is not None:
+                    fingerprint = None  # nothing to cache
+            else:
+                fingerprint = None  # already cached
+            pending_plots.append((fingerprint, plot_results))
+
+            if not np.isnan(time_to_first_sonde[k]):
+                seg["time_to_first_sonde"] = time_to_first_sonde[k]
+            if kinds_is_circle(kinds) and not np.isnan(heading_difference[k]):
+                seg["heading_difference"] = heading_difference[k]
+
+            seg["warnings"] = warnings
+
+    for seg, (fingerprint, plot_results) in zip(flightdata["segments"], pending_plots):
+        with profiler.stage("collect_plots", "segment", segment_id=seg.get("segment_id")):
+            results = []
+            for r in plot_results:
+                if not isinstance(r, tuple):
+                    r, records = r()
+                    profiler.add(records)
+                results.append(r)
+            plot_results = results
+        # failed plots are retried on the next run instead of being cached as warnings
+        if fingerprint is not None and all(warning is None for _, warning in plot_results):
+            plot_cache.put(fingerprint, plot_results)
+
+        plot_data = []
+        for url, warning in plot_results:
+            if warning is None:
+                plot_data.append(url)
+            else:
+                seg["warnings"].append(warning)
+        seg["plot_data"] = plot_data
+
+    flightdata["warnings"] = global_warnings
+
+    if profiler.enabled:
+        flightdata["timings"] = profiler.summary()
+
+    with profiler.stage("render_template"):
+        tpl = template_env().get_template("flight.html")
+        return tpl.render(flight=flightdata)
+
+
+def _load_flight(infile, sonde_index, navdata_cache=None, lazy=False, yaml_cache=True, yaml_cache_dir=None,
+                 profiler=None):
+    """
+    :returns: (flightdata, navdata, overview_navdata) as needed by render_report
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    with profiler.stage("load_yaml"):
+        flightdata = load_yaml(infile, cache=yaml_cache, cache_dir=yaml_cache_dir)
+    with profiler.stage("get_navdata"):
+        navdata = get_navdata(flightdata.get("platform", ""), flightdata.get("flight_id", ""),
+                              cache=navdata_cache)
+    with profiler.stage("load_navdata"):
+        navdata, overview_navdata = load_report_navdata(navdata, flightdata, sonde_index, lazy)
+    return flightdata, navdata, overview_navdata
+
+
+def index_entry(flightdata, href):
+    """
+    :returns: summary of a rendered flight for the campaign index
+    """
+    segments = flightdata.get("segments", [])
+    return {
+        "flight_id": flightdata.get("flight_id", ""),
+        "name": flightdata.get("name", ""),
+        "platform": flightdata.get("platform", ""),
+        "href": href,
+        "n_segments": len(segments),
+        "n_flight_warnings": len(flightdata.get("warnings", [])),
+        "n_segment_warnings": sum(len(seg.get("warnings", [])) for seg in segments),
+        "n_segments_with_warnings": sum(1 for seg in segments if seg.get("warnings")),
+    }
+
 
 def _main():
     basedir = os.path.abspath(os.path.dirname(__file__))
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("infile")
-    parser.add_argument("outfile")
+    parser.add_argument("files", nargs="+", metavar="FILE",
+                        help="segment file and HTML output file, only the segment file with --serve, "
+                             "or any number of segment files with --outdir")
+    parser.add_argument("-o", "--outdir",
+                        help="write the reports of all segment files and a campaign index.html to this directory")
     parser.add_argument("-s", "--sonde_info", help="sonde info yaml file", default=os.path.join(basedir, "sondes.yaml"))
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes used for rendering plots")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="reuse plots of segments whose inputs did not change since the last run")
+    parser.add_argument("--plot-cache-dir", help="directory for cached plots", default=default_cache_dir("plots"))
+    parser.add_argument("--lazy", action="store_true", help="only load navdata around segments and report peak memory usage")
+    parser.add_argument("--serve", action="store_true",
+                        help="serve the report on a local HTTP server, rendering plots when they are viewed")
+    parser.add_argument("--host", default="localhost", help="host to serve on")
+    parser.add_argument("--port", type=int, default=8000, help="port to serve on")
+    parser.add_argument("--plot-memory", type=int, default=256, help="MiB of rendered plots kept in memory when serving")
+    parser.add_argument("--images", choices=["inline"] + list(IMAGE_FORMATS), default="inline",
+                        help="embed plots into the HTML or write them as separate image files of the given format, "
+                             "with --outdir, image files which no report in the directory uses are removed")
+    parser.add_argument("--image-dir", help="directory for image files, defaults to images/ next to outfile")
+    parser.add_argument("--overview-dpi", type=int, default=72, help="resolution of the overview image file")
+    parser.add_argument("-t", "--tracks",
+                        help="launch positions of the sondes written by attach_sondes.py --tracks, "
+                             "instead of looking them up in navdata (not with --outdir)")
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.outdir is not None:
+        if args.serve:
+            parser.error("--serve can't be combined with --outdir")
+        if args.tracks:
+            parser.error("--tracks can't be combined with --outdir")
+        infiles = args.files
+        outfiles = [os.path.join(args.outdir, os.path.splitext(os.path.basename(f))[0] + ".html")
+                    for f in infiles]
+        # reports are named after the segment files, which may have the same name in different directories
+        names = [os.path.basename(f) for f in outfiles] + ["index.html"]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            parser.error("reports in --outdir would overwrite each other or index.html: {}".format(
+                ", ".join(f for f in infiles
+                          if os.path.splitext(os.path.basename(f))[0] + ".html" in duplicates)))
+        os.makedirs(args.outdir, exist_ok=True)
+    elif args.serve:
+        if len(args.files) != 1:
+            parser.error("--serve expects a single segment file")
+        if args.images != "inline" or args.image_dir is not None:
+            parser.error("--serve renders plots as PNG on request, it can't be combined with --images or --image-dir")
+        infiles, outfiles = args.files, [None]
+    else:
+        if len(args.files) != 2:
+            parser.error("expected a segment file and an HTML output file, use --outdir for many segment files")
+        infiles, outfiles = args.files[:1], args.files[1:]
 
-    flightdata = yaml.load(open(args.infile), Loader=yaml.SafeLoader)
-
-    checker = FlightChecker(flightdata)
-    global_warnings = list(checker.check_flight(flightdata))
+    profiler = profiler_from_args(args)
 
-    flight_id = flightdata.get("flight_id", "")
-    platform = flightdata.get("platform", "")
+    if args.images == "inline":
+        encode = overview_encode = fig2data_url
+        encoding = ""
+    else:
+        base_dir = os.path.dirname(os.path.abspath(outfiles[0]))
+        image_dir = os.path.abspath(args.image_dir or os.path.join(base_dir, "images"))
+        encode = ImageWriter(image_dir, base_dir, args.images)
+        overview_encode = ImageWriter(image_dir, base_dir, args.images, args.overview_dpi)
+        encoding = repr(encode) + repr(overview_encode)
+
+    if args.incremental:
+        plot_cache = PickleCache(args.plot_cache_dir)
+        code_version = file_fingerprint(__file__, pyramid.__file__) + encoding
+    else:
+        plot_cache = None
+        code_version = None
+
+    # plot functions return the plot result and profile records measured in worker processes
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_plot_worker)
+        plot_fn = partial(call_profiled, render_plot, profiler.trace_memory) \
+                  if profiler.enabled else _render_plot_unprofiled
+        submit_plot = lambda *plot_args, **kwargs: executor.submit(plot_fn, *plot_args, **kwargs).result
+    else:
+        executor = None
+        submit_plot = None
 
+    global_warnings = []
     if args.sonde_info is not None:
-        sonde_info = yaml.load(open(args.sonde_info), Loader=yaml.SafeLoader)
+        with profiler.stage("load_sonde_index"):
+            sonde_index = load_sonde_index(args.sonde_info, cache=not args.no_cache, cache_dir=args.cache_dir)
     else:
-        sonde_info = []
+        sonde_index = SondeIndex([])
         global_warnings.append("no sonde_info is specified, using data from unified dataset")
 
-    navdata = get_navdata(platform, flight_id).load()
-
-    sonde_info = [s for s in sonde_info if s["platform"] == platform]
-    sondes_by_id = {s["sonde_id"]: s for s in sonde_info}
-
-    fig, ax = plt.subplots()
-    ax.plot(navdata.lon, navdata.lat)
-    im = fig2data_url(fig)
-    plt.close("all")
-    flightdata["plot_data"] = im
-
-    for seg in flightdata["segments"]:
-        t_start = np.datetime64(seg["start"])
-        t_end = np.datetime64(seg["end"])
-        seg_navdata = navdata.sel(time=slice(t_start, t_end))
-        seg_before = navdata.sel(time=slice(t_start - border_time, t_start))
-        seg_after = navdata.sel(time=slice(t_end, t_end + border_time))
-
-        sondes_in_segment = [s
-                             for s in sonde_info
-                             if s["launch_time"] >= seg["start"]
-                             and s["launch_time"] < seg["end"]]
-        sondes_by_flag = {f: [s for s in sondes_in_segment if s["flag"] == f]
-                          for f in set(s["flag"] for s in sondes_in_segment)}
-
-        manual_sondes_by_flag = {f: [sondes_by_id[s] for s in sondes] for f, sondes in seg.get("dropsondes", {}).items()}
-
-        seg["sondes_by_flag"] = sondes_by_flag
-
-        sonde_times = [s["launch_time"] for s in sondes_in_segment]
-
-        sonde_tracks_by_flag = {
-            f: navdata.sel(time=[s["launch_time"] for s in sondes], method="nearest")
-            #for f, sondes in sondes_by_flag.items()
-            for f, sondes in manual_sondes_by_flag.items()
-        }
-
-        plot_data = []
-        warnings = list(checker.check_segment(seg, seg_navdata, sondes_by_flag))
-
-        for plot in plots_for_kinds(seg.get("kinds", [])):
+    load_flight = partial(_load_flight, sonde_index=sonde_index, navdata_cache=cache_from_args(args),
+                          lazy=args.lazy, yaml_cache=not args.no_cache, yaml_cache_dir=args.cache_dir)
+    pyramid_cache = None if args.no_cache else PickleCache(args.cache_dir)
+    sonde_tracks = load_sonde_tracks(args.tracks) if args.tracks else None
+    stats_cache = None if args.no_cache else statistics_cache(args.cache_dir)
+
+    if args.serve:
+        if executor is not None:
+            executor.shutdown()
+        from serve import ReportServer
+        _, navdata, overview_navdata = load_flight(infiles[0], profiler=profiler)
+        ReportServer(infiles[0], navdata, sonde_index, global_warnings,
+                     navdata_pyramid=get_pyramid(navdata, pyramid_cache),
+                     overview_navdata=overview_navdata, sonde_tracks=sonde_tracks,
+                     max_plot_bytes=args.plot_memory * 1024**2).serve_forever(args.host, args.port)
+        return
+
+    # navdata of the next flight is fetched in the background while the
+    # current one is plotted, only the background thread touches netCDF files
+    from concurrent.futures import ThreadPoolExecutor
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    prefetch = len(infiles) > 1
+    pending = prefetcher.submit(load_flight, infiles[0]) if prefetch else None
+
+    index = []
+    try:
+        for k, (infile, outfile) in enumerate(zip(infiles, outfiles)):
             try:
-                plot_data.append(fig2data_url(
-                    plot(seg_navdata, sonde_tracks_by_flag, seg_before, seg_after)))
-                plt.close("all")
+                if prefetch:
+                    current = pending
+                    if k + 1 < len(infiles):
+                        pending = prefetcher.submit(load_flight, infiles[k + 1])
+                    with profiler.stage("wait_for_navdata", "flight", filename=infile):
+                        flightdata, navdata, overview_navdata = current.result()
+                else:
+                    flightdata, navdata, overview_navdata = load_flight(infile, profiler=profiler)
+
+                html = render_report(flightdata, navdata, sonde_index, global_warnings,
+                                     submit_plot=submit_plot,
+                                     plot_cache=plot_cache,
+                                     code_version=code_version,
+                                     pyramid_cache=pyramid_cache,
+                                     statistics_cache=stats_cache,
+                                     sonde_tracks=sonde_tracks,
+                                     overview_navdata=overview_navdata,
+                                     encode=encode,
+                                     overview_encode=overview_encode,
+                                     profiler=profiler)
+                with open(outfile, "w") as f:
+                    f.write(html)
+                index.append(index_entry(flightdata, os.path.basename(outfile)))
             except Exception as e:
-                warnings.append("plot could not be created: {}".format(e))
-
-        seg["plot_data"] = plot_data
-        if len(sonde_times) > 0:
-            seg["time_to_first_sonde"] = (np.datetime64(sonde_times[0]) - t_start) / np.timedelta64(1, "s")
-        if kinds_is_circle(seg.get("kinds", [])):
-            seg["heading_difference"] = (seg_navdata.heading.data[-1] - seg_navdata.heading.data[0]) % 360
-
-        seg["warnings"] = warnings
-
-    flightdata["warnings"] = global_warnings
-
-    tpl = env.get_template("flight.html")
-
-    with open(args.outfile, "w") as outfile:
-        outfile.write(tpl.render(flight=flightdata))
+                if args.outdir is None:
+                    raise
+                error = "{}: {}".format(type(e).__name__, e)
+                print("report of {} could not be created: {}".format(infile, error), file=sys.stderr)
+                index.append({"flight_id": os.path.basename(infile), "error": error})
+    finally:
+        prefetcher.shutdown(cancel_futures=True)
+        if executor is not None:
+            executor.shutdown()
+
+    if args.outdir is not None:
+        with profiler.stage("render_index"):
+            html = template_env().get_template("index.html").render(flights=index)
+        with open(os.path.join(args.outdir, "index.html"), "w") as f:
+            f.write(html)
+        # images are named by content, those of replaced plots would pile up otherwise
+        if args.images != "inline":
+            with profiler.stage("prune_images"):
+                prune_images(image_dir, [os.path.join(args.outdir, name) for name in os.listdir(args.outdir)
+                                         if name.endswith(".html")])
+
+    profiler.finish(args.profile_output)
+
+    if args.lazy:
+        print("peak RSS: {:.1f} MiB".format(peak_rss(children=True) / 2**20), file=sys.stderr)
 
 if __name__ == "__main__":
     _main()
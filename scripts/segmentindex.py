@@ -0,0 +1,239 @@
+# time interval queries on the compiled segment catalog
+#
+# segments of every platform and kind are kept in arrays sorted by start,
+# together with the running maximum of their ends. As the running maximum is
+# sorted as well, the segments which may contain a time are found by two
+# binary searches, only that (usually tiny) range is compared element-wise.
+# Time ranges are semi-open as described in the README, segments may overlap.
+#
+# for bulk queries, the timeline is split at all segment bounds into
+# elementary intervals, each assigned the innermost segment covering it, so
+# assigning a segment to many timestamps is a single searchsorted.
+
+import numpy as np
+
+from sondeindex import to_datetime64
+
+
+def to_datetime64_array(times):
+    times = np.asarray(times)
+    if times.dtype.kind == "M":
+        return times.astype("datetime64[ns]")
+    return np.array([to_datetime64(t) for t in times.ravel()],
+                    dtype="datetime64[ns]").reshape(times.shape)
+
+
+class IntervalIndex:
+    def __init__(self, starts, ends, rows):
+        """
+        :param starts: start times of the segments
+        :param ends: end times of the segments, excluded from the segments
+        :param rows: row of every segment in the segment table
+        """
+        order = np.lexsort((-ends.view("int64"), starts.view("int64")))
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.rows = rows[order]
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+        # elementary intervals between all bounds, later (i.e. inner) segments overwrite earlier ones
+        self.bounds = np.unique(np.concatenate([self.starts, self.ends]))
+        self.innermost = np.full(max(len(self.bounds) - 1, 0), -1, dtype="int64")
+        first = np.searchsorted(self.bounds, self.starts)
+        last = np.searchsorted(self.bounds, self.ends)
+        for i, (a, b) in enumerate(zip(first.tolist(), last.tolist())):
+            self.innermost[a:b] = i
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, start, end):
+        """
+        :returns: rows of all segments overlapping [start, end), sorted by start
+        """
+        # segments before lo end before start, segments from hi on start at or after end
+        lo = np.searchsorted(self.max_ends, to_datetime64(start), side="right")
+        hi = np.searchsorted(self.starts, to_datetime64(end), side="left")
+        return self.rows[lo:hi][self.ends[lo:hi] > to_datetime64(start)]
+
+    def containing(self, t):
+        """
+        :returns: rows of all segments containing t, sorted by start
+        """
+        t = to_datetime64(t)
+        lo = np.searchsorted(self.max_ends, t, side="right")
+        hi = np.searchsorted(self.starts, t, side="right")
+        return self.rows[lo:hi][self.ends[lo:hi] > t]
+
+    def locate(self, times):
+        """
+        :param times: array of times
+        :returns: row of the innermost segment containing each time, -1 if there is none
+        """
+        times = to_datetime64_array(times)
+        if len(self.innermost) == 0:
+            return np.full(times.shape, -1, dtype="int64")
+        interval = np.searchsorted(self.bounds, times, side="right") - 1
+        inside = (interval >= 0) & (interval < len(self.innermost))
+        segment = np.where(inside, self.innermost[np.clip(interval, 0, len(self.innermost) - 1)], -1)
+        return np.where(segment >= 0, self.rows[segment], -1)
+
+
+class SegmentIndex:
+    """
+    index of the segments of a compiled catalog, partitioned by platform and kind
+    """
+    def __init__(self, segment_ids, platforms, flight_ids, starts, ends, kinds):
+        """
+        :param kinds: list of kinds for every segment
+        """
+        self.segment_ids = np.asarray(segment_ids, dtype=object)
+        self.platforms = np.asarray(platforms, dtype=object)
+        self.flight_ids = np.asarray(flight_ids, dtype=object)
+        self.starts = to_datetime64_array(starts)
+        self.ends = to_datetime64_array(ends)
+        self.kinds = [list(k) for k in kinds]
+
+        # segments without valid time range can't be found by time
+        valid = ~np.isnat(self.starts) & ~np.isnat(self.ends) & (self.starts < self.ends)
+        members = {}
+        for row in np.flatnonzero(valid).tolist():
+            platform = self.platforms[row]
+            members.setdefault((platform, None), []).append(row)
+            for kind in set(self.kinds[row]):
+                members.setdefault((platform, kind), []).append(row)
+        self.indices = {key: self._interval_index(np.array(rows, dtype="int64"))
+                        for key, rows in members.items()}
+        self._empty = self._interval_index(np.zeros(0, dtype="int64"))
+
+    def _interval_index(self, rows):
+        return IntervalIndex(self.starts[rows], self.ends[rows], rows)
+
+    @classmethod
+    def from_catalog(cls, all_flights):
+        """
+        :param all_flights: compiled catalog, dict of platform to dict of flight_id to flight
+        """
+        columns = {"segment_ids": [], "platforms": [], "flight_ids": [], "starts": [], "ends": [], "kinds": []}
+        for platform, flights in all_flights.items():
+            for flight_id, flight in flights.items():
+                for seg in flight["segments"]:
+                    columns["segment_ids"].append(seg.get("segment_id", ""))
+                    columns["platforms"].append(platform)
+                    columns["flight_ids"].append(flight_id)
+                    columns["starts"].append(seg.get("start") or np.datetime64("NaT", "ns"))
+                    columns["ends"].append(seg.get("end") or np.datetime64("NaT", "ns"))
+                    columns["kinds"].append(seg.get("kinds") or [])
+        return cls(**columns)
+
+    @classmethod
+    def from_columnar(cls, ds):
+        """
+        :param ds: segment table as written by compile.py --netcdf
+        """
+        masks = ds.kinds.attrs["flag_masks"]
+        meanings = ds.kinds.attrs["flag_meanings"].split()
+        kind_bits = ds.kinds.values
+        return cls(segment_ids=ds.segment_id.values,
+                   platforms=ds.segment_platform.values,
+                   flight_ids=ds.segment_flight_id.values,
+                   starts=ds.start.values,
+                   ends=ds.end.values,
+                   kinds=[[k for k, m in zip(meanings, masks) if bits & m] for bits in kind_bits])
+
+    def __len__(self):
+        return len(self.segment_ids)
+
+    def __getitem__(self, key):
+        """
+        :param key: platform or (platform, kind)
+        :returns: IntervalIndex of these segments, kind None selects all kinds
+        """
+        if not isinstance(key, tuple):
+            key = (key, None)
+        return self.indices.get(key, self._empty)
+
+    def _rows(self, query, platform, kind):
+        if platform is not None:
+            return query(self[platform, kind])
+        rows = [query(index) for (_, k), index in self.indices.items() if k == kind]
+        if not rows:
+            return np.zeros(0, dtype="int64")
+        rows = np.concatenate(rows)
+        return rows[np.argsort(self.starts[rows], kind="stable")]
+
+    def at(self, t, platform=None, kind=None):
+        """
+        :returns: ids of all segments containing t, sorted by start
+        """
+        return self.segment_ids[self._rows(lambda index: index.containing(t), platform, kind)].tolist()
+
+    def overlapping(self, start, end, platform=None, kind=None):
+        """
+        :returns: ids of all segments overlapping [start, end), sorted by start
+        """
+        return self.segment_ids[self._rows(lambda index: index.overlapping(start, end),
+                                           platform, kind)].tolist()
+
+    def locate(self, times, platform, kind=None):
+        """
+        assigns many timestamps of one platform at once to segments
+
+        Where segments overlap, the innermost one is chosen, that is the one
+        starting last (and ending first if they start at the same time).
+
+        :param times: array of times
+        :returns: object array of segment ids, None where no segment contains the time
+        """
+        rows = self[platform, kind].locate(times)
+        ids = np.full(rows.shape, None, dtype=object)
+        ids[rows >= 0] = self.segment_ids[rows[rows >= 0]]
+        return ids
+
+
+def _parse_segment_index(filename):
+    if filename.endswith(".nc"):
+        import xarray as xr
+        with xr.open_dataset(filename) as ds:
+            return SegmentIndex.from_columnar(ds.load())
+    from yamlload import load_yaml
+    return SegmentIndex.from_catalog(load_yaml(filename, cache=False))
+
+
+def load_segment_index(filename, cache=True, cache_dir=None):
+    """
+    :param filename: catalog written by compile.py, as YAML or as netCDF (--netcdf)
+    :param cache: keep the index in the parse cache
+    :param cache_dir: directory of the navdata cache (--cache-dir), see yamlload.load_cached
+    """
+    from yamlload import load_cached
+    return load_cached(filename, _parse_segment_index, cache, cache_dir)
+
+
+def _main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="query the segments of a compiled catalog by time")
+    parser.add_argument("catalog", help="output of compile.py (YAML or netCDF)")
+    parser.add_argument("times", nargs="+",
+                        help="one time to list the segments containing it or two times for a window")
+    parser.add_argument("-p", "--platform")
+    parser.add_argument("-k", "--kind")
+    args = parser.parse_args()
+
+    if len(args.times) > 2:
+        parser.error("give one time or a window of two times")
+
+    index = load_segment_index(args.catalog)
+    if len(args.times) == 1:
+        segment_ids = index.at(args.times[0], args.platform, args.kind)
+    else:
+        segment_ids = index.overlapping(*args.times, args.platform, args.kind)
+    for segment_id in segment_ids:
+        print(segment_id)
+    return 0
+
+__all__ = ["SegmentIndex", "IntervalIndex", "load_segment_index"]
+
+if __name__ == "__main__":
+    exit(_main())
@@ -0,0 +1,232 @@
+# summary statistics of the segments of a flight
+#
+# all statistics are computed in one pass over the navdata of the flight:
+# sums are taken from cumulative sums at the segment bounds, minima and maxima
+# from reduceat, only the circle fits are done per segment. Navdata is sliced
+# like in the checks (both bounds included), sondes are counted within the
+# semi-open segment. Tables are cached by a fingerprint of the navdata, the
+# segment times and kinds and the sondes of the platform, verify.py can write
+# them as netCDF for report.py and compile.py.
+
+import os
+import json
+import hashlib
+
+STATISTICS_VERSION = 1
+
+UNITS = {
+    "duration": "s",
+    "alt_mean": "m",
+    "alt_min": "m",
+    "alt_max": "m",
+    "roll_rms": "deg",
+    "heading_change": "deg",
+    "heading_difference": "deg",
+    "path_length": "m",
+    "circle_radius": "m",
+    "time_to_first_sonde": "s",
+}
+
+
+def _to_time(t):
+    import numpy as np
+    try:
+        return np.datetime64(t, "ns")
+    except (TypeError, ValueError):
+        return np.datetime64("NaT", "ns")
+
+
+def _interval_sums(values, first, last):
+    """
+    :returns: sums of values[first:last] for all pairs of bounds
+    """
+    import numpy as np
+    c = np.concatenate([[0.], np.cumsum(values)])
+    return c[last] - c[first]
+
+
+def _interval_reduce(ufunc, values, first, last):
+    """
+    :returns: ufunc.reduce(values[first:last]) for all pairs of bounds, NaN for empty intervals
+    """
+    import numpy as np
+    result = np.full(len(first), np.nan)
+    nonempty = last > first
+    if np.any(nonempty):
+        # reduceat over interleaved bounds, the appended element makes the bound len(values) valid
+        bounds = np.stack([first[nonempty], last[nonempty]], axis=-1).ravel()
+        result[nonempty] = ufunc.reduceat(np.append(values, np.nan), bounds)[::2]
+    return result
+
+
+def segment_statistics(flight, navdata, sonde_index):
+    """
+    :param flight: flight as read from a segment file
+    :param navdata: loaded navdata of the flight, at least covering all segments
+    :param sonde_index: SondeIndex of all sondes
+    :returns: xarray.Dataset along dimension segment, in the order of flight["segments"]
+    """
+    import numpy as np
+    import xarray as xr
+    from checkers import EARTH_RADIUS, fit_circle, kinds_is_circle
+
+    segments = flight.get("segments", [])
+    n = len(segments)
+    starts = np.array([_to_time(seg.get("start")) for seg in segments], dtype="datetime64[ns]")
+    ends = np.array([_to_time(seg.get("end")) for seg in segments], dtype="datetime64[ns]")
+
+    time = navdata.time.values
+    first = np.searchsorted(time, starts, side="left")
+    last = np.maximum(np.searchsorted(time, ends, side="right"), first)
+    count = last - first
+    nonempty = count > 0
+
+    lat = navdata["lat"].values.astype("float64")
+    lon = navdata["lon"].values.astype("float64")
+    alt = navdata["alt"].values.astype("float64")
+    roll = navdata["roll"].values.astype("float64")
+    heading = navdata["heading"].values.astype("float64")
+
+    def mean(values, squared=False):
+        valid = np.isfinite(values)
+        v = np.where(valid, values, 0.)
+        n_valid = _interval_sums(valid, first, last)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return _interval_sums(v**2 if squared else v, first, last) / n_valid
+
+    # steps between consecutive samples, counted for the segment containing both samples
+    lat_rad, lon_rad = np.deg2rad(lat), np.deg2rad(lon)
+    step = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(
+        np.sin(np.diff(lat_rad) / 2)**2
+        + np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) * np.sin(np.diff(lon_rad) / 2)**2))
+    turn = (np.diff(heading) + 180.) % 360. - 180.
+    # segments starting at or after the last sample (or without valid start) have no steps
+    step_first = np.minimum(first, len(step))
+    step_last = np.clip(last - 1, step_first, len(step))
+
+    heading_difference = np.full(n, np.nan)
+    heading_difference[nonempty] = (heading[last[nonempty] - 1] - heading[first[nonempty]]) % 360
+
+    circle_radius = np.full(n, np.nan)
+    for i, seg in enumerate(segments):
+        kinds = seg.get("kinds")
+        if isinstance(kinds, list) and kinds_is_circle(kinds):
+            valid = np.isfinite(lat[first[i]:last[i]]) & np.isfinite(lon[first[i]:last[i]])
+            if np.count_nonzero(valid) >= 3:
+                circle_radius[i] = fit_circle(lat[first[i]:last[i]][valid], lon[first[i]:last[i]][valid])[2]
+
+    variables = {
+        "duration": (ends - starts) / np.timedelta64(1, "s"),
+        "alt_mean": mean(alt),
+        "alt_min": _interval_reduce(np.fmin, alt, first, last),
+        "alt_max": _interval_reduce(np.fmax, alt, first, last),
+        "roll_rms": np.sqrt(mean(roll, squared=True)),
+        "heading_change": np.where(nonempty, _interval_sums(np.nan_to_num(turn), step_first, step_last), np.nan),
+        "heading_difference": heading_difference,
+        "path_length": np.where(nonempty, _interval_sums(np.nan_to_num(step), step_first, step_last), np.nan),
+        "circle_radius": circle_radius,
+    }
+
+    # sondes launched within the segments
+    platform_sondes = sonde_index[flight.get("platform", "")]
+    sonde_first, sonde_last = platform_sondes.windows(starts, ends)
+    sonde_last = np.maximum(sonde_last, sonde_first)
+    for code, flag in enumerate(platform_sondes.flag_names):
+        variables["n_launched_" + flag] = _interval_sums(platform_sondes.flag_codes == code,
+                                                         sonde_first, sonde_last).astype("int64")
+    with_sondes = sonde_last > sonde_first
+    time_to_first_sonde = np.full(n, np.nan)
+    time_to_first_sonde[with_sondes] = (platform_sondes.launch_times[sonde_first[with_sondes]]
+                                        - starts[with_sondes]) / np.timedelta64(1, "s")
+    variables["time_to_first_sonde"] = time_to_first_sonde
+
+    ds = xr.Dataset({
+        "segment_id": ("segment", np.array([str(seg.get("segment_id", "")) for seg in segments], dtype=object)),
+        **{name: ("segment", values) for name, values in variables.items()},
+    })
+    for name, units in UNITS.items():
+        ds[name].attrs["units"] = units
+    ds.attrs["flight_id"] = flight.get("flight_id", "")
+    return ds
+
+
+def statistics_key(flight, navdata, sonde_index):
+    """
+    :returns: fingerprint of all inputs of segment_statistics
+    """
+    from navcache import update_dataset_hash
+    h = hashlib.sha256()
+    h.update(json.dumps([STATISTICS_VERSION, flight.get("flight_id"), flight.get("platform"),
+                         [[seg.get("segment_id"), seg.get("start"), seg.get("end"), seg.get("kinds")]
+                          for seg in flight.get("segments", [])]],
+                        default=str).encode("utf-8"))
+    # navdata read from the navdata cache is identified by its content addressed file
+    source = navdata.encoding.get("source")
+    if source is not None:
+        h.update(os.path.basename(source).encode("utf-8"))
+    else:
+        update_dataset_hash(h, navdata[["lat", "lon", "alt", "roll", "heading"]])
+    platform_sondes = sonde_index[flight.get("platform", "")]
+    h.update(" ".join(platform_sondes.flag_names).encode("utf-8"))
+    h.update(platform_sondes.launch_times.tobytes())
+    h.update(platform_sondes.flag_codes.tobytes())
+    return h.hexdigest()
+
+
+def get_segment_statistics(flight, navdata, sonde_index, cache=None):
+    """
+    computes the statistics table of a flight or retrieves it from cache
+
+    :param cache: optional PickleCache for the tables
+    """
+    if cache is None:
+        return segment_statistics(flight, navdata, sonde_index)
+    key = statistics_key(flight, navdata, sonde_index)
+    ds = cache.get(key)
+    if ds is None:
+        ds = segment_statistics(flight, navdata, sonde_index)
+        ds.attrs["fingerprint"] = key
+        cache.put(key, ds)
+    return ds
+
+
+def statistics_cache(navdata_cache_dir=None):
+    """
+    :param navdata_cache_dir: directory of the navdata cache (--cache-dir), the tables are kept in a
+                              subdirectory, by default in the default cache directory for statistics
+    """
+    from navcache import PickleCache, default_cache_dir
+    cache_dir = default_cache_dir("statistics") if navdata_cache_dir is None \
+                else os.path.join(navdata_cache_dir, "statistics")
+    return PickleCache(cache_dir, max_bytes=256 * 1024**2)
+
+
+def statistics_file(directory, flight_id):
+    return os.path.join(directory, flight_id + "_statistics.nc")
+
+
+def write_statistics(ds, directory):
+    """
+    writes the table of a flight atomically into directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    filename = statistics_file(directory, ds.attrs["flight_id"])
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    ds.to_netcdf(tmp)
+    os.replace(tmp, filename)
+    return filename
+
+
+def load_statistics(directory, flight_id):
+    """
+    :returns: table of the flight written by write_statistics or None
+    """
+    import xarray as xr
+    filename = statistics_file(directory, flight_id)
+    if not os.path.exists(filename):
+        return None
+    with xr.open_dataset(filename) as ds:
+        return ds.load()
+
+__all__ = ["segment_statistics", "get_segment_statistics", "statistics_key", "statistics_cache",
+           "write_statistics", "load_statistics", "STATISTICS_VERSION"]
@@ -0,0 +1,168 @@
+# local HTTP server for flight reports
+#
+# serves the report of a flight like report.py writes it, but plots are only
+# rendered when the browser asks for them. Plot URLs contain a fingerprint of
+# all inputs of the plot, so the content behind a URL never changes: images
+# are sent with long lived caching headers and kept in an in-memory LRU cache.
+# The page itself is rendered on every request, such that changes of the
+# segment file show up after reloading.
+
+import sys
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_MAX_PLOT_BYTES = 256 * 1024**2
+
+
+class PlotLRU:
+    """
+    in-memory cache of rendered plots, evicting least recently used plots
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_PLOT_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class ReportServer:
+    def __init__(self, infile, navdata, sonde_index, global_warnings=(), navdata_pyramid=None,
+                 overview_navdata=None, sonde_tracks=None, max_plot_bytes=DEFAULT_MAX_PLOT_BYTES):
+        """
+        :param infile: segment file, read again for every page request
+        :param navdata: loaded navdata of the flight
+        :param global_warnings: additional flight warnings shown on the page
+        :param sonde_tracks: launch positions of the sondes, see report.render_report
+        :param max_plot_bytes: size of the in-memory plot cache
+        """
+        import report
+        import pyramid
+        from navcache import file_fingerprint
+
+        self.infile = infile
+        self.navdata = navdata
+        self.sonde_index = sonde_index
+        self.global_warnings = list(global_warnings)
+        self.navdata_pyramid = navdata_pyramid or pyramid.get_pyramid(navdata)
+        self.overview_navdata = overview_navdata
+        self.sonde_tracks = sonde_tracks
+        self.code_version = file_fingerprint(report.__file__, pyramid.__file__)
+        self.renderers = {}
+        self.plots = PlotLRU(max_plot_bytes)
+
+    def _defer_plot(self, fingerprint, index, render):
+        self.renderers[(fingerprint, index)] = render
+        return "plots/{}/{}.png".format(fingerprint, index)
+
+    def page(self):
+        """
+        :returns: HTML of the report, with plots referring to plot URLs
+        """
+        import report
+        from yamlload import load_yaml
+
+        renderers = self.renderers
+        self.renderers = {}
+        try:
+            return report.render_report(load_yaml(self.infile), self.navdata, self.sonde_index,
+                                        self.global_warnings,
+                                        code_version=self.code_version,
+                                        navdata_pyramid=self.navdata_pyramid,
+                                        overview_navdata=self.overview_navdata,
+                                        sonde_tracks=self.sonde_tracks,
+                                        defer_plot=self._defer_plot)
+        except Exception:
+            self.renderers = renderers
+            raise
+
+    def plot(self, fingerprint, index):
+        """
+        :returns: (PNG, None), (None, warning) or None if the plot is unknown
+        """
+        import report
+
+        key = (fingerprint, index)
+        png = self.plots.get(key)
+        if png is not None:
+            return png, None
+        if key not in self.renderers:
+            return None
+        png, warning = self.renderers[key](encode=report.fig2png)
+        if png is not None:
+            self.plots.put(key, png)
+        return png, warning
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send(self, status, content_type, body, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                parts = path.strip("/").split("/")
+                if path == "/":
+                    try:
+                        html = server.page()
+                    except Exception as e:
+                        self.send(500, "text/plain; charset=utf-8",
+                                  "report could not be created: {}".format(e).encode("utf-8"))
+                        return
+                    self.send(200, "text/html; charset=utf-8", html.encode("utf-8"),
+                              [("Cache-Control", "no-cache")])
+                elif len(parts) == 3 and parts[0] == "plots" and parts[2].endswith(".png") \
+                        and parts[2][:-4].isdigit():
+                    fingerprint, index = parts[1], int(parts[2][:-4])
+                    etag = '"{}-{}"'.format(fingerprint, index)
+                    caching = [("Cache-Control", "public, max-age=31536000, immutable"), ("ETag", etag)]
+                    if self.headers.get("If-None-Match") == etag:
+                        self.send_response(304)
+                        for name, value in caching:
+                            self.send_header(name, value)
+                        self.end_headers()
+                        return
+                    result = server.plot(fingerprint, index)
+                    if result is None:
+                        self.send(404, "text/plain; charset=utf-8", b"unknown plot, reload the report")
+                    elif result[0] is None:
+                        self.send(500, "text/plain; charset=utf-8", result[1].encode("utf-8"))
+                    else:
+                        self.send(200, "image/png", result[0], caching)
+                else:
+                    self.send(404, "text/plain; charset=utf-8", b"not found")
+
+        return Handler
+
+    def serve_forever(self, host="localhost", port=8000):
+        httpd = HTTPServer((host, port), self.handler_class())
+        print("serving report of {} on http://{}:{}/, press Ctrl-C to stop".format(
+              self.infile, host, httpd.server_address[1]), file=sys.stderr)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+
+__all__ = ["PlotLRU", "ReportServer"]
@@ -0,0 +1,125 @@
+
+
+def to_datetime64(t):
+    import numpy as np
+    return np.datetime64(t, "ns")
+
+
+class PlatformSondes:
+    def __init__(self, sondes, flag_names):
+        import numpy as np
+        launch_times = np.array([to_datetime64(s["launch_time"]) for s in sondes],
+                                dtype="datetime64[ns]")
+        order = np.argsort(launch_times, kind="stable")
+        self.sondes = [sondes[i] for i in order]
+        self.launch_times = launch_times[order]
+        # position of every sonde in sondes.yaml, results keep that order as sondes.yaml is not sorted by time
+        self.file_positions = order
+        self.flag_names = flag_names
+        flag_lookup = {f: i for i, f in enumerate(flag_names)}
+        self.flag_codes = np.array([flag_lookup[s["flag"]] for s in self.sondes], dtype="int16")
+
+    def __len__(self):
+        return len(self.sondes)
+
+    def window(self, start, end):
+        """
+        :returns: (first, last) index into self.sondes of all sondes in [start, end)
+        """
+        first, last = self.windows([start], [end])
+        return int(first[0]), int(last[0])
+
+    def windows(self, starts, ends):
+        """
+        vectorized version of window for many time ranges at once
+
+        :returns: arrays of first and last indices
+        """
+        import numpy as np
+        starts = np.asarray([to_datetime64(t) for t in starts], dtype="datetime64[ns]")
+        ends = np.asarray([to_datetime64(t) for t in ends], dtype="datetime64[ns]")
+        # time ranges are semi-open, so both bounds are searched from the left
+        return (np.searchsorted(self.launch_times, starts, side="left"),
+                np.searchsorted(self.launch_times, ends, side="left"))
+
+    def sondes_by_flag(self, start, end, flags=None):
+        """
+        :param flags: flags to include in the output, all flags present in the time range by default
+        :returns: dict of flag to list of sondes launched within [start, end), in the order of sondes.yaml
+        """
+        first, last = self.window(start, end)
+        return self._group_by_flag(first, last, flags)
+
+    def sonde_ids_by_flag_windows(self, starts, ends, flags=None):
+        """
+        vectorized lookup of the sonde ids within many time ranges at once
+
+        :returns: list of dicts of flag to list of sonde ids launched within [start, end)
+        """
+        firsts, lasts = self.windows(starts, ends)
+        return [{f: [s["sonde_id"] for s in sondes]
+                 for f, sondes in self._group_by_flag(first, max(first, last), flags).items()}
+                for first, last in zip(firsts.tolist(), lasts.tolist())]
+
+    def _group_by_flag(self, first, last, flags=None):
+        import numpy as np
+        codes = self.flag_codes[first:last]
+        if flags is None:
+            flags = [self.flag_names[c] for c in np.unique(codes)]
+        result = {}
+        for flag in flags:
+            try:
+                code = self.flag_names.index(flag)
+            except ValueError:
+                result[flag] = []
+                continue
+            indices = first + np.flatnonzero(codes == code)
+            indices = indices[np.argsort(self.file_positions[indices], kind="stable")]
+            result[flag] = [self.sondes[i] for i in indices]
+        return result
+
+
+class SondeIndex:
+    """
+    index of sonde info entries, partitioned by platform and sorted by launch time
+    """
+    def __init__(self, sonde_info):
+        """
+        :param sonde_info: list of sonde dicts as found in sondes.yaml
+        """
+        flag_names = list(sorted(set(s["flag"] for s in sonde_info)))
+        by_platform = {}
+        for s in sonde_info:
+            by_platform.setdefault(s["platform"], []).append(s)
+        self.platforms = {platform: PlatformSondes(sondes, flag_names)
+                          for platform, sondes in by_platform.items()}
+        self.flag_names = flag_names
+        self.sondes_by_id = {s["sonde_id"]: s for s in sonde_info}
+
+    def __getitem__(self, platform):
+        if platform not in self.platforms:
+            return PlatformSondes([], self.flag_names)
+        return self.platforms[platform]
+
+    def sondes_by_flag(self, platform, start, end, flags=None):
+        return self[platform].sondes_by_flag(start, end, flags)
+
+    def sonde_ids_by_flag(self, platform, start, end, flags=None):
+        return {f: [s["sonde_id"] for s in sondes]
+                for f, sondes in self.sondes_by_flag(platform, start, end, flags).items()}
+
+
+def _parse_sonde_index(filename):
+    from yamlload import load_yaml
+    return SondeIndex(load_yaml(filename, cache=False))
+
+
+def load_sonde_index(filename, cache=True, cache_dir=None):
+    """
+    :param cache: keep the index (including launch times as datetime64) in the parse cache
+    :param cache_dir: directory of the navdata cache (--cache-dir), see yamlload.load_cached
+    """
+    from yamlload import load_cached
+    return load_cached(filename, _parse_sonde_index, cache, cache_dir)
+
+__all__ = ["SondeIndex", "load_sonde_index"]
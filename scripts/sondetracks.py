@@ -0,0 +1,123 @@
+# positions of the aircraft at sonde launches
+#
+# the launch positions of all sondes of a flight are looked up at once with a
+# single searchsorted on the time axis of the navdata, either at the nearest
+# sample or linearly interpolated between the neighbouring samples. The result
+# is a small table (sonde_id, flag, time, lat, lon, alt), which plots index
+# into by sonde id and which attach_sondes.py can write to disk, so the launch
+# positions are available without loading navdata again.
+
+
+TRACK_VARIABLES = ["lat", "lon", "alt"]
+
+
+def lookup_positions(times, values, query, interpolate=False):
+    """
+    :param times: sorted sample times
+    :param values: dict of variable name to samples
+    :param query: times to look up
+    :param interpolate: interpolate linearly between samples instead of taking the nearest sample
+    :returns: dict of variable name to values at the query times, NaN if there are no samples
+    """
+    import numpy as np
+    query = np.asarray(query, dtype="datetime64[ns]")
+    times = np.asarray(times, dtype="datetime64[ns]")
+    if len(times) == 0:
+        return {name: np.full(len(query), np.nan) for name in values}
+
+    right = np.clip(np.searchsorted(times, query, side="left"), 0, len(times) - 1)
+    left = np.clip(right - 1, 0, len(times) - 1)
+    if interpolate:
+        dt = (times[right] - times[left]).astype("int64")
+        weight = np.clip(np.divide((query - times[left]).astype("int64"), dt,
+                                   out=np.zeros(len(query)), where=dt > 0), 0., 1.)
+        return {name: (1 - weight) * np.asarray(v, dtype="float64")[left]
+                      + weight * np.asarray(v, dtype="float64")[right]
+                for name, v in values.items()}
+
+    # like .sel(method="nearest"), ties go to the later sample
+    nearest = np.where(np.abs(query - times[left]) < np.abs(times[right] - query), left, right)
+    return {name: np.asarray(v)[nearest] for name, v in values.items()}
+
+
+class SondeTracks:
+    """
+    launch positions of the sondes of a flight
+    """
+    def __init__(self, ds):
+        """
+        :param ds: xarray.Dataset along dimension sonde with sonde_id, flag, time, lat, lon and alt
+        """
+        self.ds = ds
+        self.positions = {(sonde_id, flag): i
+                          for i, (sonde_id, flag) in enumerate(zip(ds.sonde_id.values.tolist(),
+                                                                   ds.flag.values.tolist()))}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def covers(self, sonde_ids_by_flag):
+        """
+        :returns: True if the positions of all given sondes are known
+        """
+        return all((s, flag) in self.positions
+                   for flag, sonde_ids in sonde_ids_by_flag.items() for s in sonde_ids or [])
+
+    def by_flag(self, sonde_ids_by_flag):
+        """
+        :param sonde_ids_by_flag: dict of flag to sonde ids, e.g. the dropsondes of a segment
+        :returns: dict of flag to tracks of these sondes, sondes without known position are left out
+        """
+        import numpy as np
+        return {flag: self.ds.isel(sonde=np.array([self.positions[(s, flag)]
+                                                   for s in sonde_ids
+                                                   if (s, flag) in self.positions], dtype="int64"))
+                for flag, sonde_ids in sonde_ids_by_flag.items()}
+
+    def to_netcdf(self, filename):
+        self.ds.to_netcdf(filename)
+
+
+def sonde_tracks(navdata, sondes, interpolate=False):
+    """
+    :param navdata: navdata with time and TRACK_VARIABLES
+    :param sondes: list of (sonde_id, flag, launch_time)
+    :returns: SondeTracks
+    """
+    import numpy as np
+    import xarray as xr
+    sonde_ids = np.array([s[0] for s in sondes], dtype=object)
+    flags = np.array([s[1] for s in sondes], dtype=object)
+    launch_times = np.array([np.datetime64(s[2], "ns") for s in sondes], dtype="datetime64[ns]")
+    positions = lookup_positions(navdata.time.values,
+                                 {name: navdata[name].values for name in TRACK_VARIABLES},
+                                 launch_times, interpolate)
+    return SondeTracks(xr.Dataset({
+        "sonde_id": ("sonde", sonde_ids),
+        "flag": ("sonde", flags),
+        "time": ("sonde", launch_times),
+        **{name: ("sonde", values) for name, values in positions.items()},
+    }))
+
+
+def flight_sonde_tracks(flight, navdata, sonde_index, interpolate=False):
+    """
+    :param flight: flight as read from a segment file
+    :returns: SondeTracks of all sondes attached to segments of the flight, with the flag used in the segment
+    """
+    sondes_by_id = sonde_index.sondes_by_id
+    sondes = {}
+    for seg in flight.get("segments", []):
+        for flag, sonde_ids in (seg.get("dropsondes") or {}).items():
+            for sonde_id in sonde_ids or []:
+                if sonde_id in sondes_by_id:
+                    sondes[(sonde_id, flag)] = sondes_by_id[sonde_id]["launch_time"]
+    return sonde_tracks(navdata, [(sonde_id, flag, t) for (sonde_id, flag), t in sondes.items()], interpolate)
+
+
+def load_sonde_tracks(filename):
+    import xarray as xr
+    with xr.open_dataset(filename) as ds:
+        return SondeTracks(ds.load())
+
+__all__ = ["SondeTracks", "sonde_tracks", "flight_sonde_tracks", "load_sonde_tracks", "lookup_positions"]
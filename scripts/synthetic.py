@@ -0,0 +1,166 @@
+# synthetic flights for benchmarks and offline runs
+#
+# the generated navdata mimics the reduced BAHAMAS data returned by
+# navdata.get_navdata: the aircraft flies alternating straight legs and
+# circles of about 200 km diameter at constant altitude, with roll angles
+# following from coordinated turns.
+
+import datetime
+import numpy as np
+
+EARTH_RADIUS = 6371e3
+GRAVITY = 9.81
+
+SYNTHETIC_PLATFORM = "SYNTHETIC"
+
+
+def _ramp(t, t0, t1):
+    return np.clip((t - t0) / (t1 - t0), 0., 1.)
+
+
+def synthetic_flight(flight_id, takeoff, n_circles=4, rate_hz=10, platform=SYNTHETIC_PLATFORM,
+                     leg_duration=1800., circle_radius=100e3, speed=230., seed=0):
+    """
+    generates navdata, a segment file and sondes for a flight
+
+    Every circle is preceded by a straight leg. Twelve sondes are launched
+    per circle, the first one a minute after the start of the circle.
+
+    :param takeoff: datetime of the start of the first leg
+    :param rate_hz: sample rate of the navdata
+    :returns: (navdata, flight, sondes)
+    """
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    circle_duration = 2 * np.pi * circle_radius / speed
+    turn_rate = speed / circle_radius
+    roll_in = 30.  # seconds to roll into and out of a turn
+
+    maneuvers = []  # (kind, start, end, direction) in seconds since takeoff
+    t = 0.
+    for i in range(n_circles):
+        maneuvers.append(("straight_leg", t, t + leg_duration, 0))
+        t += leg_duration
+        maneuvers.append(("circle", t, t + circle_duration, 1 if i % 2 == 0 else -1))
+        t += circle_duration
+    maneuvers.append(("straight_leg", t, t + leg_duration, 0))
+    t += leg_duration
+
+    seconds = np.arange(0., t, 1. / rate_hz)
+    heading_rate = np.zeros_like(seconds)
+    for kind, start, end, direction in maneuvers:
+        if kind == "circle":
+            heading_rate += direction * turn_rate * (_ramp(seconds, start - roll_in, start)
+                                                     - _ramp(seconds, end, end + roll_in))
+
+    heading = np.deg2rad(rng.uniform(0, 360)) + np.cumsum(heading_rate) / rate_hz
+    lat = np.deg2rad(13.) + np.cumsum(speed * np.cos(heading)) / rate_hz / EARTH_RADIUS
+    lon = np.deg2rad(-40.) + np.cumsum(speed * np.sin(heading) / np.cos(lat)) / rate_hz / EARTH_RADIUS
+    roll = np.rad2deg(np.arctan(speed * heading_rate / GRAVITY))
+
+    t0 = np.datetime64(takeoff, "ns")
+    time = t0 + (seconds * 1e9).astype("timedelta64[ns]")
+    n = len(seconds)
+    navdata = xr.Dataset({
+        "lat": ("time", np.rad2deg(lat)),
+        "lon": ("time", np.rad2deg(lon)),
+        "alt": ("time", 10000. + np.cumsum(rng.normal(0, .05, n))),
+        "roll": ("time", roll + rng.normal(0, .1, n)),
+        "pitch": ("time", 2. + rng.normal(0, .1, n)),
+        "heading": ("time", np.rad2deg(heading) % 360),
+    }, coords={"time": time})
+
+    def to_datetime(s):
+        return takeoff + datetime.timedelta(seconds=round(float(s)))
+
+    segments = []
+    sondes = []
+    for i, (kind, start, end, direction) in enumerate(maneuvers):
+        segment_id = "{}_{}{:02d}".format(flight_id, "c" if kind == "circle" else "l", i)
+        seg_sondes = []
+        if kind == "circle":
+            for j in range(12):
+                launch = start + 60. + j * circle_duration / 12
+                seg_sondes.append({
+                    "flag": str(rng.choice(["GOOD", "BAD", "UGLY"], p=[.9, .05, .05])),
+                    "launch_time": to_datetime(launch),
+                    "platform": platform,
+                    "sonde_id": "{}_s{:02d}{:02d}".format(flight_id, i, j),
+                })
+        sondes += seg_sondes
+        segments.append({
+            "segment_id": segment_id,
+            "name": "{} {}".format(kind.replace("_", " "), i),
+            "start": to_datetime(start),
+            "end": to_datetime(end),
+            "kinds": [kind],
+            "irregularities": [],
+            "dropsondes": {flag: [s["sonde_id"] for s in seg_sondes if s["flag"] == flag]
+                           for flag in ["GOOD", "BAD", "UGLY"]},
+        })
+
+    flight = {
+        "flight_id": flight_id,
+        "name": "synthetic flight {}".format(flight_id),
+        "platform": platform,
+        "mission": "SYNTHETIC",
+        "takeoff": takeoff,
+        "landing": to_datetime(t),
+        "segments": segments,
+    }
+    return navdata, flight, sondes
+
+
+def takeoff_of(flight_id):
+    """
+    :param flight_id: flight id ending in the date of the flight, e.g. SYNTHETIC-20240801a
+    :returns: midnight of that date as takeoff time
+    """
+    import re
+    match = re.search(r"(\d{8})[a-z]?$", flight_id)
+    if match is None:
+        raise ValueError("flight id {} does not end in a date".format(flight_id))
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d")
+
+
+def filler_sondes(n, platform="FILLER", seed=0):
+    """
+    :returns: n sondes of another platform to make sonde files campaign sized
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2024, 8, 1)
+    offsets = np.sort(rng.uniform(0, 60 * 86400, n))
+    flags = rng.choice(["GOOD", "BAD", "UGLY"], size=n, p=[.9, .05, .05])
+    return [{"flag": str(flag),
+             "launch_time": start + datetime.timedelta(seconds=round(float(offset))),
+             "platform": platform,
+             "sonde_id": "{}_s{:06d}".format(platform, i)}
+            for i, (offset, flag) in enumerate(zip(offsets, flags))]
+
+
+def _main():
+    import os
+    import argparse
+    import yaml
+    parser = argparse.ArgumentParser(description="write segment files and sondes of synthetic flights, "
+                                                 "their navdata is provided by the synthetic navdata backend")
+    parser.add_argument("flight_ids", nargs="+", help="flight ids ending in a date, e.g. SYNTHETIC-20240801a")
+    parser.add_argument("-o", "--outdir", default=".", help="directory for the segment files and sondes.yaml")
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    all_sondes = []
+    for flight_id in args.flight_ids:
+        _, flight, sondes = synthetic_flight(flight_id, takeoff_of(flight_id))
+        all_sondes += sondes
+        with open(os.path.join(args.outdir, flight_id + ".yaml"), "w") as f:
+            yaml.dump(flight, f, sort_keys=False)
+    with open(os.path.join(args.outdir, "sondes.yaml"), "w") as f:
+        yaml.dump(all_sondes, f)
+    return 0
+
+__all__ = ["synthetic_flight", "filler_sondes", "takeoff_of", "SYNTHETIC_PLATFORM"]
+
+if __name__ == "__main__":
+    exit(_main())
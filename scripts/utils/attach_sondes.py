@@ -1,46 +1,130 @@
+import os
+import sys
 import ruamel.yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sondeindex import load_sonde_index
+from navcache import add_cache_arguments, cache_from_args
+
+SONDE_FLAGS = ["GOOD", "BAD", "UGLY"]
+
+
+def _plain(dropsondes):
+    """
+    :returns: dropsondes of a segment as dict of flag to list of sonde ids, None if missing or malformed
+    """
+    if not isinstance(dropsondes, dict):
+        return None
+    return {flag: list(sonde_ids or []) for flag, sonde_ids in dropsondes.items()}
+
+
+def attach_sondes(flight, sonde_index):
+    """
+    sets the dropsondes of all segments of a flight, segments which are already up to date are not touched
+
+    :param flight: flight as loaded by the round-trip loader
+    :returns: list of (segment_id, old dropsondes, new dropsondes) of the changed segments
+    """
+    segments = flight.get("segments") or []
+    sonde_ids_by_flag = sonde_index[flight["platform"]].sonde_ids_by_flag_windows(
+        [seg["start"] for seg in segments], [seg["end"] for seg in segments], SONDE_FLAGS)
+
+    changes = []
+    for seg, sonde_ids in zip(segments, sonde_ids_by_flag):
+        old = _plain(seg.get("dropsondes"))
+        outdated = "good_dropsondes" in seg
+        if outdated:
+            del seg["good_dropsondes"]
+        if old != sonde_ids or outdated:
+            seg["dropsondes"] = sonde_ids
+            changes.append((seg.get("segment_id", seg.get("name")), old, sonde_ids))
+    return changes
+
+
+def describe_change(old, new):
+    if old is None:
+        return "dropsondes added ({})".format(", ".join("{} {}".format(len(ids), flag) for flag, ids in new.items()))
+    parts = []
+    for flag in list(new) + [f for f in old if f not in new]:
+        before = set(old.get(flag, []))
+        after = set(new.get(flag, []))
+        if after - before:
+            parts.append("{} +{}".format(flag, len(after - before)))
+        if before - after:
+            parts.append("{} -{}".format(flag, len(before - after)))
+    return ", ".join(parts) or "reordered"
+
+
+def write_atomic(filename, flight, yaml):
+    """
+    replaces filename by the dumped flight, such that readers never see a partially written file
+    """
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp, "w") as outfile:
+            yaml.dump(flight, outfile)
+        os.chmod(tmp, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def _main():
     import argparse
     parser = argparse.ArgumentParser(description="""
 attaches dropsonde ids to segment files
 
-NOTE: the flight_segment file will be overwritten by this program.
+NOTE: the flight_segment files will be overwritten by this program, only
+files in which the dropsondes of a segment change are written.
 """)
-    parser.add_argument("flight_segment", help="flight info YAML file")
+    parser.add_argument("flight_segments", nargs="+", metavar="flight_segment", help="flight info YAML files")
     parser.add_argument("sonde_info", help="sonde info YAML file")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only print which segments would change, don't write any files")
+    parser.add_argument("-t", "--tracks",
+                        help="also write the launch positions of the attached sondes to this netCDF file "
+                             "(only for a single flight_segment)")
+    parser.add_argument("--interpolate", action="store_true",
+                        help="interpolate launch positions between navdata samples instead of using the nearest sample")
+    add_cache_arguments(parser)
     args = parser.parse_args()
+    if args.tracks and len(args.flight_segments) > 1:
+        parser.error("--tracks requires a single flight_segment")
 
-    with open(args.flight_segment) as infile:
-        flight = ruamel.yaml.load(infile, Loader=ruamel.yaml.RoundTripLoader)
+    yaml = ruamel.yaml.YAML()
+    sonde_index = load_sonde_index(args.sonde_info)
 
-    with open(args.sonde_info) as sondefile:
-        sonde_info = ruamel.yaml.load(sondefile, Loader=ruamel.yaml.SafeLoader)
+    n_errors = 0
+    n_changed_files = 0
+    for filename in args.flight_segments:
+        with open(filename) as infile:
+            flight = yaml.load(infile)
 
-    if "platform" not in flight:
-        print("ERROR: platform must be specified in flight file")
-        return -1
+        if "platform" not in flight:
+            print("ERROR: platform must be specified in flight file {}".format(filename), file=sys.stderr)
+            n_errors += 1
+            continue
 
-    platform = flight["platform"]
+        changes = attach_sondes(flight, sonde_index)
+        if changes:
+            n_changed_files += 1
+            print("{}: {} segments changed".format(filename, len(changes)))
+            for segment_id, old, new in changes:
+                print("  {}: {}".format(segment_id, describe_change(old, new)))
+            if not args.dry_run:
+                write_atomic(filename, flight, yaml)
 
-    for seg in flight["segments"]:
-        if "good_dropsondes" in seg:
-            del seg["good_dropsondes"]
-        sonde_ids = {
-            flag: [s["sonde_id"]
-                   for s in sonde_info
-                   if s["platform"] == platform
-                   and s["flag"] == flag
-                   and s["launch_time"] >= seg["start"]
-                   and s["launch_time"] < seg["end"]]
-            for flag in ["GOOD", "BAD", "UGLY"]
-        }
-        seg["dropsondes"] = sonde_ids
-
-    with open(args.flight_segment, "w") as outfile:
-        ruamel.yaml.dump(flight, outfile, Dumper=ruamel.yaml.RoundTripDumper)
-
-    return 0
+        if args.tracks and not args.dry_run:
+            from navdata import get_navdata
+            from sondetracks import flight_sonde_tracks
+            navdata = get_navdata(flight["platform"], flight["flight_id"], cache=cache_from_args(args))
+            flight_sonde_tracks(flight, navdata, sonde_index, args.interpolate).to_netcdf(args.tracks)
+
+    print("{} of {} files {}".format(n_changed_files, len(args.flight_segments),
+                                     "would change" if args.dry_run else "changed"), file=sys.stderr)
+    return 1 if n_errors else 0
 
 if __name__ == "__main__":
     exit(_main())
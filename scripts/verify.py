@@ -1,51 +1,227 @@
 import os
+import sys
 import logging
 import traceback
-import yaml
-import numpy as np
 from contextlib import closing
+from functools import partial
 
 
-from navdata import get_navdata
-from checkers import FlightChecker
+from navdata import get_navdata, load_windows
+from navcache import add_cache_arguments, cache_from_args
+from checkers import check_flight_batch, split_warnings
+from sondeindex import load_sonde_index
+from yamlload import load_yaml
+from profiling import Profiler, call_profiled, add_profile_arguments, profiler_from_args, peak_rss
 
-def validate(segment_file, sonde_info):
+def collect_warnings(segment_file, sonde_index, cache=None, lazy=False, statistics_dir=None, schema_only=False,
+                     profiler=None):
+    """
+    runs all checks on a segment file
+
+    :param lazy: only load navdata within segments instead of the whole flight
+    :param statistics_dir: if given, the segment statistics of the flight are written to this directory
+    :param schema_only: only check the segment file and sondes, without loading navdata
+    :param profiler: optional Profiler to record the time spent in each stage
+
+    :returns: list of flight warnings and list of (segment_id, warnings) per segment
+    """
+    import numpy as np
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+
+    with profiler.stage("load_yaml"):
+        flightdata = load_yaml(segment_file, cache=cache is not None,
+                               cache_dir=None if cache is None else cache.cache_dir)
+    if schema_only:
+        with profiler.stage("checks", "flight", flight_id=flightdata.get("flight_id")):
+            return split_warnings(check_flight_batch(flightdata, None, sonde_index), flightdata)
+    with profiler.stage("get_navdata"):
+        navdata = get_navdata(flightdata["platform"], flightdata["flight_id"], cache=cache)
+    with profiler.stage("load_navdata"):
+        if lazy:
+            navdata = load_windows(navdata, [(np.datetime64(seg["start"]), np.datetime64(seg["end"]))
+                                             for seg in flightdata["segments"]])
+        else:
+            navdata = navdata.load()
+
+    with closing(navdata):
+        with profiler.stage("checks", "flight", flight_id=flightdata["flight_id"]):
+            warnings = check_flight_batch(flightdata, navdata, sonde_index)
+        if statistics_dir is not None:
+            with profiler.stage("statistics", "flight", flight_id=flightdata["flight_id"]):
+                from segmentstats import get_segment_statistics, statistics_cache, write_statistics
+                write_statistics(get_segment_statistics(flightdata, navdata, sonde_index,
+                                                        statistics_cache(cache.cache_dir) if cache is not None else None),
+                                 statistics_dir)
+
+    return split_warnings(warnings, flightdata)
+
+
+def log_warnings(flight_warnings, segment_warnings):
     flightlogger = logging.getLogger("flight")
     segmentlogger = logging.getLogger("segment")
 
-    flightdata = yaml.load(open(segment_file), Loader=yaml.SafeLoader)
-    checker = FlightChecker(flightdata)
-    sonde_info = [s for s in sonde_info if s["platform"] == flightdata["platform"]]
-
-    flight_warnings = list(checker.check_flight(flightdata))
     for warning in flight_warnings:
         flightlogger.warning(warning)
 
     segment_warning_count = 0
-    with closing(get_navdata(flightdata["platform"], flightdata["flight_id"]).load()) as navdata:
-        for seg in flightdata["segments"]:
-            t_start = np.datetime64(seg["start"])
-            t_end = np.datetime64(seg["end"])
-            seg_navdata = navdata.sel(time=slice(t_start, t_end))
-
-            sondes_in_segment = [s
-                                 for s in sonde_info
-                                 if s["launch_time"] >= seg["start"]
-                                 and s["launch_time"] < seg["end"]]
-            sondes_by_flag = {f: [s for s in sondes_in_segment if s["flag"] == f]
-                              for f in set(s["flag"] for s in sondes_in_segment)}
-
-            warnings = list(checker.check_segment(seg, seg_navdata, sondes_by_flag))
-            for warning in warnings:
-                if "segment_id" in seg:
-                    segmentlogger.warning(seg["segment_id"])
-                segmentlogger.warning(warning)
-
-            segment_warning_count += len(warnings)
+    for segment_id, warnings in segment_warnings:
+        for warning in warnings:
+            if segment_id is not None:
+                segmentlogger.warning(segment_id)
+            segmentlogger.warning(warning)
+        segment_warning_count += len(warnings)
 
     return len(flight_warnings), segment_warning_count
 
 
+def _collect_warnings_unprofiled(*collect_args):
+    return collect_warnings(*collect_args), []
+
+
+def validate(segment_file, sonde_index, cache=None, lazy=False):
+    return log_warnings(*collect_warnings(segment_file, sonde_index, cache, lazy))
+
+
+def _watched_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".yaml"))
+        else:
+            files.append(path)
+    return files
+
+
+def _file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _warning_lines(flight_warnings, segment_warnings):
+    return ["flight: " + w for w in flight_warnings] + \
+           ["{}: {}".format(segment_id, w) for segment_id, warnings in segment_warnings for w in warnings]
+
+
+def watch(paths, sonde_info, cache=None, report_dir=None, interval=.5):
+    """
+    re-verifies segment files whenever they or the sonde info change
+
+    Navdata, navdata pyramids and the sonde index are kept in memory, such
+    that only the checks (and optionally the report) of the changed flight
+    are run again. Changes in the warnings are printed as a diff.
+
+    :param paths: segment files or directories containing segment files
+    :param report_dir: if given, the HTML report of changed flights is written to this directory
+    :param interval: polling interval in seconds
+    """
+    import time
+    from checkers import check_flight_batch, split_warnings
+
+    if report_dir is not None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import report
+        import pyramid
+        from navcache import PickleCache, default_cache_dir, file_fingerprint
+        os.makedirs(report_dir, exist_ok=True)
+        if cache is not None:
+            plot_cache = PickleCache(default_cache_dir("plots"))
+            code_version = file_fingerprint(report.__file__, pyramid.__file__)
+            pyramid_cache = PickleCache(cache.cache_dir)
+        else:
+            plot_cache = code_version = pyramid_cache = None
+
+    navdata_by_flight = {}
+    pyramid_by_flight = {}
+    signatures = {}
+    previous_warnings = {}
+    sonde_signature = failed_sonde_signature = None
+    sonde_index = None
+
+    print("watching {} for changes, press Ctrl-C to stop".format(", ".join(paths)), file=sys.stderr)
+    try:
+        while True:
+            changed = []
+            signature = _file_signature(sonde_info)
+            if signature != sonde_signature and signature != failed_sonde_signature:
+                # sondes.yaml may be read while it is being written, keep the previous sondes until it loads
+                try:
+                    sonde_index = load_sonde_index(sonde_info, cache=cache is not None,
+                                                   cache_dir=None if cache is None else cache.cache_dir)
+                except Exception as e:
+                    failed_sonde_signature = signature
+                    print("[{}] {} could not be loaded: {}".format(time.strftime("%H:%M:%S"), sonde_info, e))
+                else:
+                    sonde_signature = signature
+                    failed_sonde_signature = None
+                    signatures = {}  # all flights depend on the sondes
+            if sonde_index is None:
+                time.sleep(interval)
+                continue
+
+            files = _watched_files(paths)
+            for filename in set(signatures) - set(files):
+                del signatures[filename]
+                previous_warnings.pop(filename, None)
+            for filename in files:
+                signature = _file_signature(filename)
+                if signature is not None and signature != signatures.get(filename):
+                    signatures[filename] = signature
+                    changed.append(filename)
+
+            for filename in changed:
+                t0 = time.perf_counter()
+                try:
+                    flightdata = load_yaml(filename, cache=cache is not None,
+                                           cache_dir=None if cache is None else cache.cache_dir)
+                    key = (flightdata["platform"], flightdata["flight_id"])
+                    if key not in navdata_by_flight:
+                        navdata_by_flight[key] = get_navdata(*key, cache=cache).load()
+                    navdata = navdata_by_flight[key]
+                    lines = _warning_lines(*split_warnings(check_flight_batch(flightdata, navdata, sonde_index),
+                                                           flightdata))
+                except Exception as e:
+                    lines = ["exception: {}".format(e)]
+                    flightdata = None
+
+                before = previous_warnings.get(filename)
+                previous_warnings[filename] = lines
+                print("[{}] {}: {} warnings in {:.2f} s".format(time.strftime("%H:%M:%S"), filename,
+                                                               len(lines), time.perf_counter() - t0))
+                if before is None:
+                    removed, added = [], lines
+                else:
+                    removed = [l for l in before if l not in lines]
+                    added = [l for l in lines if l not in before]
+                for line in removed:
+                    print("  - " + line)
+                for line in added:
+                    print("  + " + line)
+                sys.stdout.flush()
+
+                if report_dir is not None and flightdata is not None:
+                    try:
+                        if key not in pyramid_by_flight:
+                            pyramid_by_flight[key] = pyramid.get_pyramid(navdata, pyramid_cache)
+                        html = report.render_report(flightdata, navdata, sonde_index,
+                                                    plot_cache=plot_cache, code_version=code_version,
+                                                    navdata_pyramid=pyramid_by_flight[key])
+                        outfile = os.path.join(report_dir, flightdata["flight_id"] + ".html")
+                        with open(outfile, "w") as f:
+                            f.write(html)
+                        print("  report written to {}".format(outfile))
+                    except Exception as e:
+                        print("  report could not be created: {}".format(e))
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+
+
 def _main():
     try:
         import coloredlogs
@@ -61,16 +237,69 @@ def _main():
     parser = argparse.ArgumentParser()
     parser.add_argument("infiles", type=str, nargs="+")
     parser.add_argument("-s", "--sonde_info", help="sonde info yaml file", default=os.path.join(basedir, "sondes.yaml"))
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of flights to verify in parallel")
+    parser.add_argument("--lazy", action="store_true", help="only load navdata within segments and report peak memory usage")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and re-verify segment files (or directories of them) when they change")
+    parser.add_argument("--report-dir", help="in watch mode, also write HTML reports of changed flights to this directory")
+    parser.add_argument("--prefetch", metavar="GATEWAY", nargs="?", const="https://ipfs.io/ipfs/",
+                        help="fetch navdata of all flights concurrently before verifying, "
+                             "optionally from the given IPFS gateway or local CID directory")
+    parser.add_argument("--schema-only", action="store_true",
+                        help="only check the segment files and sondes, without loading any navdata")
+    parser.add_argument("--statistics", metavar="DIR",
+                        help="write a table of segment statistics per flight to this directory, "
+                             "which compile.py --statistics can add to the catalog")
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
-    sonde_info = yaml.load(open(args.sonde_info), Loader=yaml.SafeLoader)
+    if args.schema_only and (args.statistics or args.watch or args.prefetch is not None):
+        parser.error("--schema-only can't be combined with --statistics, --watch or --prefetch")
+
+    cache = cache_from_args(args)
+
+    if args.watch:
+        return watch(args.infiles, args.sonde_info, cache, args.report_dir)
+    profiler = profiler_from_args(args)
+
+    if args.prefetch is not None:
+        from prefetch import prefetch, flights_of
+        flights = flights_of(args.infiles, not args.no_cache, args.cache_dir)
+        with profiler.stage("prefetch"):
+            for filename, result in zip(args.infiles, prefetch(flights, args.prefetch)):
+                if isinstance(result, Exception):
+                    mainlogger.warning("prefetching navdata for %s failed: %s", filename, result)
+
+    with profiler.stage("load_sonde_index"):
+        sonde_index = load_sonde_index(args.sonde_info, cache=not args.no_cache, cache_dir=args.cache_dir)
+
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        # results are collected in order of the input files, such that the
+        # warnings are logged deterministically. Workers return their profile
+        # records along with the results.
+        collect = partial(call_profiled, collect_warnings, profiler.trace_memory) \
+                  if profiler.enabled else _collect_warnings_unprofiled
+        get_results = [executor.submit(collect, filename, sonde_index, cache, args.lazy, args.statistics,
+                                       args.schema_only).result
+                       for filename in args.infiles]
+    else:
+        executor = None
+        collect = lambda *collect_args: (collect_warnings(*collect_args, profiler=profiler), [])
+        get_results = [partial(collect, filename, sonde_index, cache, args.lazy, args.statistics,
+                               args.schema_only)
+                       for filename in args.infiles]
 
     total_warnings = 0
-    for filename in tqdm.tqdm(args.infiles):
+    for filename, get_result in tqdm.tqdm(list(zip(args.infiles, get_results))):
         mainlogger.info("verifying %s", filename)
         try:
-            flight_warning_count, segment_warning_count = validate(
-                        filename, sonde_info)
+            with profiler.stage("validate", "flight", filename=filename):
+                result, records = get_result()
+                profiler.add(records)
+            flight_warning_count, segment_warning_count = log_warnings(*result)
             total_warnings += flight_warning_count + segment_warning_count
             mainlogger.info("%d flight warnings, %d segment warnings",
                             flight_warning_count,
@@ -81,6 +310,13 @@ def _main():
             mainlogger.error("exception while processing segment file %s: %s",
                              filename, e)
 
+    if executor is not None:
+        executor.shutdown()
+
+    profiler.finish(args.profile_output)
+
+    if args.lazy:
+        print("peak RSS: {:.1f} MiB".format(peak_rss(children=True) / 2**20), file=sys.stderr)
 
     if total_warnings == 0:
         return 0
@@ -0,0 +1,60 @@
+# shared loading of YAML files
+#
+# uses the libyaml based loader if available and keeps parsed results in a
+# pickle cache, keyed on path, modification time and size of the file, such
+# that repeated runs (e.g. in a pre-commit hook) don't parse unchanged files.
+
+import os
+import yaml
+
+try:
+    SafeLoader = yaml.CSafeLoader
+except AttributeError:
+    SafeLoader = yaml.SafeLoader
+
+# increase if the structure of cached objects changes
+CACHE_VERSION = 3
+
+
+def _parse_yaml(filename):
+    with open(filename) as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def load_cached(filename, parse=_parse_yaml, cache=True, cache_dir=None):
+    """
+    :param parse: function to turn the filename into the object to be cached
+    :param cache: use the parse cache
+    :param cache_dir: directory of the navdata cache (--cache-dir), the parse cache is kept in a
+                      subdirectory, by default in the default cache directory for YAML files
+    """
+    if not cache:
+        return parse(filename)
+
+    from navcache import PickleCache, cache_key, default_cache_dir
+    parse_cache = PickleCache(default_cache_dir("yaml") if cache_dir is None else os.path.join(cache_dir, "yaml"),
+                              max_bytes=256 * 1024**2)
+    st = os.stat(filename)
+    key = cache_key(os.path.abspath(filename), st.st_mtime_ns, st.st_size,
+                    parse.__module__, parse.__qualname__, CACHE_VERSION)
+    try:
+        value = parse_cache.get(key)
+    except Exception:
+        value = None  # treat unreadable entries as missing
+    if value is None:
+        value = parse(filename)
+        try:
+            parse_cache.put(key, value)
+        except OSError:
+            pass  # a read-only cache must not prevent loading
+    return value
+
+
+def load_yaml(filename, cache=True, cache_dir=None):
+    """
+    :param cache: use the parse cache
+    :param cache_dir: directory of the navdata cache (--cache-dir), see load_cached
+    """
+    return load_cached(filename, _parse_yaml, cache, cache_dir)
+
+__all__ = ["SafeLoader", "load_cached", "load_yaml"]